@@ -0,0 +1,524 @@
+"""
+Headless benchmarks for the game. No window is opened, so it can run on a server.
+
+Run it from the folder with my_game.py (highscores_config.yml must exist):
+
+    python benchmark.py spawn
+    python benchmark.py reset
+    python benchmark.py hitbox
+    python benchmark.py governor
+    python benchmark.py snapshot
+    python benchmark.py multiplayer
+    python benchmark.py soak
+
+The soak benchmark plays the real game, so it needs OpenGL. On a server
+without a display, run it with ARCADE_HEADLESS=1.
+"""
+
+import argparse
+import asyncio
+import gc
+import math
+import os
+import random
+from contextlib import ExitStack, contextmanager
+from math import inf
+from time import perf_counter
+from unittest import mock
+
+import arcade
+import arcade.sections
+from pyglet.math import Vec2
+
+import my_game
+import game_server
+
+# arcade checks collisions with more sprites than this in one list on the GPU
+HITBOX_MAX_ASTEROIDS = 1500
+
+
+class HeadlessCamera():
+    """
+    Stands in for arcade.Camera, which needs a window
+    """
+    def __init__(self, *args, **kwargs):
+        self.goal_position = Vec2(0, 0)
+
+    def move_to(self, vector, speed=1.0):
+        self.goal_position = Vec2(*vector)
+
+    def shake(self, *args, **kwargs):
+        pass
+
+    def use(self):
+        pass
+
+
+class HeadlessAtlas():
+    def __init__(self):
+        self.textures = set()
+
+    def add(self, texture):
+        self.textures.add(texture)
+
+
+class HeadlessContext():
+    def __init__(self):
+        self.default_atlas = HeadlessAtlas()
+
+
+class HeadlessWindow():
+    """
+    Stands in for arcade.Window. Views are shown, but never drawn
+    """
+    def __init__(self):
+        self.width = my_game.SCREEN_WIDTH
+        self.height = my_game.SCREEN_HEIGHT
+        self.ctx = HeadlessContext()
+        self.current_view = None
+
+    def show_view(self, view):
+        self.current_view = view
+
+
+class LazySpriteList(arcade.SpriteList):
+    """
+    A SpriteList which never makes its OpenGL buffers. The buffers kept in
+    Python are still made and grown like in a normal SpriteList
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs["lazy"] = True
+        super().__init__(*args, **kwargs)
+
+
+@contextmanager
+def headless_game_view():
+    """
+    Yields a GameView with its window, camera and sprite list buffers replaced,
+    so the game logic can run without OpenGL. Sound is off
+    """
+    window = HeadlessWindow()
+    with mock.patch.object(arcade, "Camera", HeadlessCamera), \
+            mock.patch.object(arcade.sections, "Camera", HeadlessCamera), \
+            mock.patch.object(arcade, "SpriteList", LazySpriteList), \
+            mock.patch.object(arcade, "set_background_color", lambda color: None), \
+            mock.patch.object(arcade, "get_joysticks", lambda: []), \
+            mock.patch.object(my_game, "SOUND_ON", False):
+        view = my_game.GameView(window)
+        window.show_view(view)
+        view.on_show_view()
+        yield view
+
+
+def percentile(values, p):
+    """
+    Returns the p'th percentile of values
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, frame_times):
+    """
+    Print frame time statistics in milliseconds
+    """
+    print("{:<30} p50 {:6.2f} ms   p99 {:6.2f} ms   max {:6.2f} ms".format(
+        name,
+        percentile(frame_times, 50) * 1000,
+        percentile(frame_times, 99) * 1000,
+        max(frame_times) * 1000
+    ))
+
+
+def bench_spawn(frames, hits_per_frame, start_level):
+    """
+    Shoot asteroids every frame and measure frame times, with and without the spawn budget
+    """
+    player = my_game.Player(center_x=my_game.PLAYER_START_X, center_y=my_game.PLAYER_START_Y)
+
+    for name, spawner in [
+        ("all at once", my_game.AsteroidSpawner(player, per_frame=inf, budget_seconds=inf)),
+        ("budgeted", my_game.AsteroidSpawner(player)),
+    ]:
+        random.seed(1)
+        gc.collect()
+
+        # Lazy lists do not need a window
+        asteroids_list = arcade.SpriteList(lazy=True)
+        level = start_level
+        frame_times = []
+
+        for frame in range(frames):
+            start = perf_counter()
+
+            # Next level when all asteroids are gone
+            if len(asteroids_list) + spawner.pending == 0:
+                level += 1
+                spawner.add_level(level)
+
+            # Split some asteroids like shots do in the game
+            for a in random.sample(asteroids_list.sprite_list, min(hits_per_frame, len(asteroids_list))):
+                if a.size > 1:
+                    for direction in [-1, 1]:
+                        spawner.add(a.size - 1, a.center_x, a.center_y, a.angle + direction * 30)
+                a.kill()
+
+            spawner.update(asteroids_list)
+            asteroids_list.on_update(1 / 60)
+
+            frame_times.append(perf_counter() - start)
+
+        report("spawn: " + name, frame_times)
+
+
+def bench_reset(levels):
+    """
+    Fill the game with asteroids, shots and UFOs and call GameView.reset() like level
+    changes and deaths do. The lists and their buffers must be kept
+    """
+    random.seed(1)
+    with headless_game_view() as view:
+        # Every level from the first one to the one with the most asteroids
+        max_level = next(level for level in range(1, 10 ** 6)
+                         if my_game.asteroids_for_level(level) == my_game.ASTEROIDS_MAX_PER_LEVEL)
+
+        chunk_lists = list(view.asteroids_list.chunks.values())
+        other_lists = [view.player_shot_list, view.UFO_list, view.ships_list]
+        capacities = [sprite_list._buf_capacity for sprite_list in chunk_lists + other_lists]
+        rocket_emitter = view.player_rocket_emitter
+
+        gc.collect()
+        frame_times = []
+        for i in range(levels):
+            view.level = random.randint(1, max_level)
+
+            start = perf_counter()
+            view.reset()
+            frame_times.append(perf_counter() - start)
+
+            # Spawn the whole level, and split off asteroids like shots do
+            spawner = view.asteroid_spawner
+            while spawner.pending:
+                spawner.update(view.asteroids_list)
+            for a in random.sample(list(view.asteroids_list), len(view.asteroids_list) // 2):
+                for direction in [-1, 1]:
+                    spawner.add(a.size, a.center_x, a.center_y, a.angle + direction * 30)
+                a.kill()
+            while spawner.pending:
+                spawner.update(view.asteroids_list)
+
+            for j in range(10):
+                view.fire_shot()
+            for j in range(3):
+                ufo = my_game.BonusUFO()
+                view.UFO_list.append(ufo)
+                view.ships_list.append(ufo)
+
+        report("reset: GameView.reset()", frame_times)
+
+        # The same lists and the same buffers, and only one rocket emitter
+        assert list(view.asteroids_list.chunks.values()) == chunk_lists, "asteroid chunk lists were made again"
+        assert [sprite_list._buf_capacity for sprite_list in chunk_lists + other_lists] == capacities, \
+            "sprite list buffers were reallocated"
+        assert view.player_rocket_emitter is rocket_emitter, "rocket emitter was made again"
+        print("reset: {} levels up to {} asteroids, buffer capacities kept at {}".format(
+            levels, my_game.ASTEROIDS_MAX_PER_LEVEL * 3 // 2, capacities
+        ))
+
+
+def forget_hit_box(sprite):
+    """
+    Make arcade forget the hit box it has calculated for sprite
+    """
+    sprite.center_x += 1
+    sprite.center_x -= 1
+
+
+def bench_hitbox(asteroid_count, frames):
+    """
+    Wrap asteroids around the world and check shots for hits every frame, with GameView.screen_wrap()
+    and get_asteroids_hit(), with and without the hit box cache
+    """
+    # More asteroids in one list are checked for collisions on the GPU, which needs a window
+    if asteroid_count > HITBOX_MAX_ASTEROIDS:
+        print("hitbox: {} asteroids, more are checked on the GPU".format(HITBOX_MAX_ASTEROIDS))
+        asteroid_count = HITBOX_MAX_ASTEROIDS
+
+    random.seed(1)
+    with headless_game_view() as view:
+        for i in range(asteroid_count):
+            view.asteroids_list.append(my_game.Asteroid(random.randint(1, my_game.ASTEROIDS_DEFAULT_SIZE), view.player_sprite))
+        for i in range(10):
+            view.fire_shot()
+        for shot in view.player_shot_list:
+            shot.position = (random.uniform(0, my_game.WORLD_WIDTH), random.uniform(0, my_game.WORLD_HEIGHT))
+        view.asteroid_spawner.clear()
+        view.awake_asteroids_lists = view.get_asteroids_lists(my_game.CHUNK_WAKE_DISTANCE)
+
+        # Both runs start from the same asteroids
+        start_state = view.save_state()
+
+        results = {}
+        for name, patches in [
+            ("arcade", [
+                mock.patch.object(my_game.Asteroid, attribute, getattr(arcade.Sprite, attribute))
+                for attribute in ["get_adjusted_hit_box", "left", "right", "top", "bottom"]
+            ]),
+            ("cached", []),
+        ]:
+            view.restore_state(start_state)
+            with ExitStack() as stack:
+                for patch in patches:
+                    stack.enter_context(patch)
+
+                gc.collect()
+                frame_times = []
+                hits = 0
+                for frame in range(frames):
+                    for asteroids in view.awake_asteroids_lists:
+                        asteroids.on_update(1 / 60)
+                    start = perf_counter()
+                    for asteroids in view.awake_asteroids_lists:
+                        view.screen_wrap(asteroids)
+                    for sprite in [view.player_sprite] + list(view.player_shot_list):
+                        hits += len(view.get_asteroids_hit(sprite))
+                    frame_times.append(perf_counter() - start)
+            report("hitbox: " + name, frame_times)
+            print("hitbox: {} hits".format(hits))
+            results[name] = sum(frame_times)
+
+        print("hitbox: cached is {:.1f} times faster with {} asteroids".format(
+            results["arcade"] / results["cached"], asteroid_count
+        ))
+
+        asteroids = view.asteroids_list
+
+    # Compare the cached hit boxes and sides with the ones arcade calculates
+    max_error = 0
+    for a in asteroids:
+        forget_hit_box(a)
+        cached = a.get_adjusted_hit_box()
+        cached_sides = [a.left, a.right, a.top, a.bottom]
+        forget_hit_box(a)
+        exact = arcade.Sprite.get_adjusted_hit_box(a)
+        exact_sides = [side.fget(a) for side in [arcade.Sprite.left, arcade.Sprite.right, arcade.Sprite.top, arcade.Sprite.bottom]]
+        for (x1, y1), (x2, y2) in zip(cached, exact):
+            max_error = max(max_error, arcade.get_distance(x1, y1, x2, y2))
+        for side1, side2 in zip(cached_sides, exact_sides):
+            max_error = max(max_error, abs(side1 - side2))
+
+    # A point can move at most this far when the angle is rounded to the nearest step
+    allowed_error = max(arcade.get_distance(0, 0, x, y) * a.scale for a in asteroids for x, y in a.hit_box) \
+        * 2 * math.sin(math.radians(my_game.ASTEROIDS_HIT_BOX_ANGLE_STEP / 4)) + 0.1
+    print("hitbox: largest difference {:.2f} px (allowed {:.2f} px)".format(max_error, allowed_error))
+    assert max_error <= allowed_error, "cached hit boxes are too far from arcade's hit boxes"
+
+
+def bench_governor():
+    """
+    Feed the quality governor slow frames, then fast frames, and check it lowers and restores quality
+    """
+    governor = my_game.QualityGovernor()
+    budget = governor.frame_budget
+
+    # Seconds of frames with a frame time, as a factor of the budget
+    phases = [("normal", 2, 0.8), ("overloaded", 10, 2.0), ("recovered", 10, 0.5)]
+
+    lowest = 1.0
+    for name, seconds, load in phases:
+        for frame in range(int(seconds / budget)):
+            # A little noise, like real frames
+            governor.add_frame(budget * load * random.uniform(0.9, 1.1))
+            lowest = min(lowest, governor.quality)
+        print("governor: {:<11} quality {:.2f}  particles {:>2}/10  shake {:4.1f}  voices {}".format(
+            name,
+            governor.quality,
+            governor.particle_count(10),
+            governor.shake_amplitude(my_game.SHAKE_AMPLITUDE),
+            governor.sound_voices()
+        ))
+
+    assert lowest == governor.min_quality, "quality was not lowered under load"
+    assert governor.quality == 1.0, "quality was not restored after load"
+
+
+def bench_snapshot(asteroid_count, frames):
+    """
+    Save and restore the state of a game with many asteroids, UFOs and shots
+    with GameView.save_state() and restore_state()
+    """
+    random.seed(1)
+    with headless_game_view() as view:
+        for i in range(asteroid_count):
+            view.asteroids_list.append(my_game.Asteroid(random.randint(1, my_game.ASTEROIDS_DEFAULT_SIZE), view.player_sprite))
+        for i in range(3):
+            ufo = my_game.BonusUFO()
+            view.UFO_list.append(ufo)
+            view.ships_list.append(ufo)
+        for i in range(10):
+            view.fire_shot()
+        view.asteroid_spawner.clear()
+
+        save_times = []
+        restore_times = []
+
+        gc.collect()
+        for frame in range(frames):
+            start = perf_counter()
+            data = view.save_state()
+            save_times.append(perf_counter() - start)
+
+            # Move everything, so restoring has something to change. A whole frame would
+            # check collisions on the GPU with this many asteroids, which needs a window
+            for asteroids in view.asteroids_list.chunks.values():
+                asteroids.on_update(1 / 60)
+            view.UFO_list.on_update(1 / 60)
+            view.player_shot_list.update()
+
+            start = perf_counter()
+            view.restore_state(data)
+            restore_times.append(perf_counter() - start)
+
+        report("snapshot: save_state", save_times)
+        report("snapshot: restore_state", restore_times)
+        print("snapshot: {} bytes for {} asteroids".format(len(data), asteroid_count))
+
+        # Restoring again must give the same state
+        assert view.save_state() == data, "restored state differs from the saved state"
+
+
+def bench_multiplayer(client_count, seconds, start_level):
+    """
+    Run a server with many simulated clients on this computer, pressing random keys
+    """
+    random.seed(1)
+    server = game_server.GameServer(start_level)
+    asteroid_count = len(server.asteroids)
+
+    async def play(client, server_task):
+        while not server_task.done():
+            client.send_input(random.choice([-1, 0, 1]), random.random() < 0.3, random.random() < 0.05)
+            await asyncio.sleep(1 / game_server.SERVER_TICK_RATE)
+
+    async def run():
+        server_task = asyncio.create_task(server.run(ticks=int(seconds * game_server.SERVER_TICK_RATE)))
+        # Give the server time to start listening
+        await asyncio.sleep(0.1)
+
+        clients = []
+        for i in range(client_count):
+            client = game_server.GameClient()
+            await client.connect()
+            clients.append(client)
+
+        await asyncio.gather(
+            server_task,
+            *[client.receive() for client in clients],
+            *[play(client, server_task) for client in clients]
+        )
+        return clients
+
+    clients = asyncio.run(run())
+
+    report("multiplayer: server tick", server.tick_times)
+    print("multiplayer: {} clients, {} asteroids at start, {:.1f} kB/s received per client".format(
+        client_count,
+        asteroid_count,
+        sum(c.bytes_received for c in clients) / len(clients) / seconds / 1000
+    ))
+
+
+def bench_soak(hours, sample_seconds, memory_log):
+    """
+    Play game after game for hours of game time, as fast as possible, and fail if
+    memory or the number of objects of any category keeps growing
+    """
+    random.seed(1)
+    window = arcade.Window(my_game.SCREEN_WIDTH, my_game.SCREEN_HEIGHT, "Soak test", visible=False)
+    window.show_view(my_game.MenuView())
+
+    # Game over saves the score. The real highscores are put back afterwards
+    highscores = None
+    if os.path.exists("highscores.yml"):
+        with open("highscores.yml", "rb") as f:
+            highscores = f.read()
+
+    tracker = my_game.MemoryTracker(sample_seconds, memory_log)
+    keys = [arcade.key.LEFT, arcade.key.RIGHT, arcade.key.UP, my_game.FIRE_KEY]
+    delta_time = 1 / 60
+    games = 0
+
+    try:
+        for frame in range(int(hours * 3600 / delta_time)):
+            view = window.current_view
+
+            if isinstance(view, my_game.GameView):
+                # Press and release keys at random, a few times a second
+                if random.random() < 0.1:
+                    key = random.choice(keys)
+                    if key in view.input.keys:
+                        view.on_key_release(key, 0)
+                    else:
+                        view.on_key_press(key, 0)
+                view.on_update(delta_time)
+            else:
+                # Menu and game over go on with any key
+                if isinstance(view, my_game.MenuView):
+                    games += 1
+                view.on_key_press(arcade.key.SPACE, 0)
+
+            window.current_view.on_draw()
+            tracker.update(delta_time)
+
+            if frame % int(3600 / delta_time) == 0:
+                print("soak: {:.0f} hours played, {} games, {} kB traced".format(
+                    tracker.time / 3600, games, tracker.samples[-1]["traced_kb"]
+                ))
+    finally:
+        tracker.close()
+        window.close()
+        if highscores is not None:
+            with open("highscores.yml", "wb") as f:
+                f.write(highscores)
+        elif os.path.exists("highscores.yml"):
+            os.remove("highscores.yml")
+
+    growth = tracker.growth_per_hour()
+    for name, value in growth.items():
+        print("soak: {:<12} {:+10.1f} per hour (allowed {})".format(
+            name, value, my_game.MEMORY_MAX_GROWTH_PER_HOUR.get(name, "any")
+        ))
+
+    too_fast = tracker.check()
+    assert not too_fast, "growing too fast: " + ", ".join(too_fast)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless benchmarks")
+    parser.add_argument("benchmark", choices=["spawn", "reset", "hitbox", "governor", "snapshot", "multiplayer", "soak"])
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--hits-per-frame", type=int, default=10)
+    parser.add_argument("--start-level", type=int, default=200)
+    parser.add_argument("--levels", type=int, default=1000)
+    parser.add_argument("--asteroids", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--hours", type=float, default=4, help="Game time to play in the soak benchmark")
+    parser.add_argument("--sample-seconds", type=float, default=my_game.MEMORY_SAMPLE_SECONDS)
+    parser.add_argument("--memory-log", default=None, help="CSV file for the memory samples of the soak benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark == "spawn":
+        bench_spawn(args.frames, args.hits_per_frame, args.start_level)
+    elif args.benchmark == "reset":
+        bench_reset(args.levels)
+    elif args.benchmark == "hitbox":
+        bench_hitbox(args.asteroids, args.frames)
+    elif args.benchmark == "governor":
+        bench_governor()
+    elif args.benchmark == "snapshot":
+        bench_snapshot(args.asteroids, args.frames)
+    elif args.benchmark == "multiplayer":
+        bench_multiplayer(args.clients, args.seconds, args.start_level)
+    elif args.benchmark == "soak":
+        bench_soak(args.hours, args.sample_seconds, args.memory_log)
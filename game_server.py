@@ -0,0 +1,531 @@
+"""
+Multiplayer for the game. The server runs the game rules for all players,
+and sends the changes to the clients every tick.
+
+Entities moving in a straight line (asteroids, shots, drifting players) are only
+sent when they appear or change direction. Clients work out where they are by now
+from their position, speed and the tick they were sent in. This keeps the data
+sent every tick small, no matter how many asteroids there are.
+
+Start a server:
+
+    python game_server.py
+
+Load test with simulated clients on this computer:
+
+    python benchmark.py multiplayer
+"""
+
+import asyncio
+import random
+import struct
+from collections import deque
+from math import sin, cos, pi, sqrt, radians
+from time import perf_counter
+
+import my_game
+from my_game import WORLD_WIDTH, WORLD_HEIGHT
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_TICK_RATE = 60
+
+# Distance at which things collide. Asteroids get bigger with their size
+SERVER_ASTEROID_RADIUS_PER_SIZE = 9
+SERVER_PLAYER_RADIUS = 20
+# Smallest size of the cells of the grid used to find collisions. Must be more than the
+# largest collision distance, as only the cells next to an entity are searched
+SERVER_GRID_SIZE = 64
+# Tick times kept for statistics
+SERVER_TICK_TIMES_KEPT = SERVER_TICK_RATE * 600
+# Inputs kept for each player. A client sending faster than the tick rate loses its oldest inputs
+SERVER_MAX_QUEUED_INPUTS = SERVER_TICK_RATE // 2
+# Clients with more data than this waiting to be sent are too slow, and are disconnected
+SERVER_MAX_BUFFERED_BYTES = 1024 * 1024
+
+# Types of messages
+MESSAGE_WELCOME = 1
+MESSAGE_STATE = 2
+MESSAGE_INPUT = 3
+
+# Types of entities
+KIND_PLAYER = 0
+KIND_ASTEROID = 1
+KIND_SHOT = 2
+
+# Every message starts with its length
+MESSAGE_LENGTH = struct.Struct("<I")
+# Type, id of the client's player
+WELCOME = struct.Struct("<BI")
+# Type, number of the input, rotation (-1, 0, 1), thrust (0, 1), fire (0, 1)
+INPUT = struct.Struct("<BIbBB")
+# Type, tick, last input used, score, lives, level, number of changed and removed entities
+STATE_HEADER = struct.Struct("<BIIIBHII")
+# Id, kind, size, center_x, center_y, change_x, change_y, angle, change_angle
+ENTITY = struct.Struct("<IBBffffff")
+# Id of a removed entity
+REMOVED = struct.Struct("<I")
+
+
+class Entity():
+    """
+    Something moving in the world
+    """
+    def __init__(self, kind, center_x, center_y, change_x=0.0, change_y=0.0, angle=0.0, change_angle=0.0, size=0):
+        self.id = None
+        self.kind = kind
+        self.center_x = center_x
+        self.center_y = center_y
+        self.change_x = change_x
+        self.change_y = change_y
+        self.angle = angle
+        self.change_angle = change_angle
+        self.size = size
+
+    def move(self, ticks=1):
+        """
+        Move the entity, wrapping around the world
+        """
+        self.center_x = (self.center_x + self.change_x * ticks) % WORLD_WIDTH
+        self.center_y = (self.center_y + self.change_y * ticks) % WORLD_HEIGHT
+        self.angle += self.change_angle * ticks
+
+    def pack(self):
+        return ENTITY.pack(
+            self.id, self.kind, self.size,
+            self.center_x, self.center_y, self.change_x, self.change_y, self.angle, self.change_angle
+        )
+
+
+def apply_input(player, rotate, thrust):
+    """
+    Turn and speed up a player like Player does in the game.
+    Used by both the server and the client, so the client can predict its own player.
+    Returns True if the player was changed
+    """
+    if rotate:
+        player.angle += rotate * my_game.PLAYER_ROTATE_SPEED
+
+    if thrust:
+        player.change_x += my_game.PLAYER_THRUST * cos(radians(player.angle) + pi / 2)
+        player.change_y += my_game.PLAYER_THRUST * sin(radians(player.angle) + pi / 2)
+
+        speed = sqrt(player.change_x ** 2 + player.change_y ** 2)
+
+        if speed > my_game.PLAYER_MAX_SPEED:
+            player.change_x /= speed / my_game.PLAYER_MAX_SPEED
+            player.change_y /= speed / my_game.PLAYER_MAX_SPEED
+
+    return bool(rotate or thrust)
+
+
+class ServerPlayer():
+    """
+    A client connected to the server, and the player it controls
+    """
+    def __init__(self, entity, writer):
+        self.entity = entity
+        self.writer = writer
+        self.score = 0
+        self.lives = my_game.PLAYER_LIVES
+
+        # Inputs not used yet. One is used every tick
+        self.inputs = deque(maxlen=SERVER_MAX_QUEUED_INPUTS)
+        self.last_input = 0
+
+        # New clients get everything once, then only changes
+        self.has_full_state = False
+
+        # Bytes sent to this client
+        self.bytes_sent = 0
+
+
+class GameServer():
+    """
+    Runs the game for all players and sends the changes to them every tick
+    """
+    def __init__(self, start_level=1):
+        self.tick = 0
+        self.level = start_level
+
+        # All entities by id
+        self.entities = {}
+        self.next_id = 1
+
+        self.asteroids = {}
+        # Shots by id, with the id of the player who fired and the distance traveled
+        self.shots = {}
+        self.players = []
+
+        # Ids of entities changed and removed in this tick
+        self.changed = set()
+        self.removed = []
+
+        # Time each of the latest ticks took
+        self.tick_times = deque(maxlen=SERVER_TICK_TIMES_KEPT)
+
+        # The world is split into whole cells, at least SERVER_GRID_SIZE wide and high
+        self.grid_columns = max(1, WORLD_WIDTH // SERVER_GRID_SIZE)
+        self.grid_rows = max(1, WORLD_HEIGHT // SERVER_GRID_SIZE)
+        self.cell_width = WORLD_WIDTH / self.grid_columns
+        self.cell_height = WORLD_HEIGHT / self.grid_rows
+
+        self.spawn_level()
+
+    def add_entity(self, entity):
+        entity.id = self.next_id
+        self.next_id += 1
+        self.entities[entity.id] = entity
+        self.changed.add(entity.id)
+        return entity
+
+    def remove_entity(self, entity):
+        del self.entities[entity.id]
+        self.changed.discard(entity.id)
+        self.removed.append(entity.id)
+
+    def add_asteroid(self, size, center_x=None, center_y=None, angle=None):
+        if center_x is None:
+            # Keep away from a random player, like asteroids in the game keep away from the player
+            if self.players:
+                center_x, center_y = my_game.get_spawn_position(random.choice(self.players).entity)
+            else:
+                center_x, center_y = random.uniform(0, WORLD_WIDTH), random.uniform(0, WORLD_HEIGHT)
+
+        if angle is None:
+            angle = random.uniform(0, 360)
+
+        asteroid = self.add_entity(Entity(
+            KIND_ASTEROID,
+            center_x,
+            center_y,
+            my_game.ASTEROIDS_SPEED * cos(radians(angle)),
+            my_game.ASTEROIDS_SPEED * sin(radians(angle)),
+            angle,
+            random.uniform(-1, 1),
+            size
+        ))
+        self.asteroids[asteroid.id] = asteroid
+
+    def spawn_level(self):
+        for i in range(my_game.asteroids_for_level(self.level)):
+            self.add_asteroid(my_game.ASTEROIDS_DEFAULT_SIZE)
+
+    def add_player(self, writer):
+        entity = self.add_entity(Entity(KIND_PLAYER, my_game.PLAYER_START_X, my_game.PLAYER_START_Y))
+        player = ServerPlayer(entity, writer)
+        self.players.append(player)
+        return player
+
+    def remove_player(self, player):
+        self.players.remove(player)
+        self.remove_entity(player.entity)
+
+    def fire(self, player):
+        p = player.entity
+        shot = self.add_entity(Entity(
+            KIND_SHOT,
+            p.center_x,
+            p.center_y,
+            my_game.PLAYER_SHOT_SPEED * cos(radians(p.angle) + pi / 2),
+            my_game.PLAYER_SHOT_SPEED * sin(radians(p.angle) + pi / 2),
+            p.angle
+        ))
+        self.shots[shot.id] = [shot, player, 0]
+
+    def player_dies(self, player):
+        """
+        Put the player back in the middle. A player with no more lives starts over
+        """
+        player.lives -= 1
+        if player.lives < 1:
+            player.lives = my_game.PLAYER_LIVES
+            player.score = 0
+
+        p = player.entity
+        p.center_x, p.center_y = my_game.PLAYER_START_X, my_game.PLAYER_START_Y
+        p.change_x = p.change_y = 0
+        self.changed.add(p.id)
+
+    def get_cell(self, entity):
+        """
+        Returns (column, row) of the grid cell entity is in
+        """
+        return (
+            int(entity.center_x // self.cell_width) % self.grid_columns,
+            int(entity.center_y // self.cell_height) % self.grid_rows
+        )
+
+    def get_grid(self):
+        """
+        Returns the asteroids sorted into grid cells
+        """
+        grid = {}
+        for a in self.asteroids.values():
+            grid.setdefault(self.get_cell(a), []).append(a)
+        return grid
+
+    def get_asteroid_hit(self, grid, entity, radius):
+        """
+        Returns an asteroid colliding with entity, or None
+        """
+        column, row = self.get_cell(entity)
+
+        # Look in the cells around the entity, also across the edges of the world
+        cells = {
+            ((column + dx) % self.grid_columns, (row + dy) % self.grid_rows)
+            for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+        }
+        for cell in cells:
+            for a in grid.get(cell, ()):
+                if a.id in self.asteroids:
+                    # Distance the short way around the world
+                    dx = abs(a.center_x - entity.center_x)
+                    dy = abs(a.center_y - entity.center_y)
+                    dx = min(dx, WORLD_WIDTH - dx)
+                    dy = min(dy, WORLD_HEIGHT - dy)
+
+                    distance = radius + a.size * SERVER_ASTEROID_RADIUS_PER_SIZE
+                    if dx ** 2 + dy ** 2 < distance ** 2:
+                        return a
+        return None
+
+    def update(self):
+        """
+        Run one tick of the game
+        """
+        start = perf_counter()
+        self.tick += 1
+
+        # Use one input from every player
+        for player in self.players:
+            if player.inputs:
+                number, rotate, thrust, fire = player.inputs.popleft()
+                player.last_input = number
+                if apply_input(player.entity, rotate, thrust):
+                    self.changed.add(player.entity.id)
+                if fire:
+                    self.fire(player)
+
+        for e in self.entities.values():
+            e.move()
+
+        # Shots disappear when they have flown their range
+        for record in list(self.shots.values()):
+            record[2] += my_game.PLAYER_SHOT_SPEED
+            if record[2] > my_game.PLAYER_SHOT_RANGE:
+                del self.shots[record[0].id]
+                self.remove_entity(record[0])
+
+        grid = self.get_grid()
+
+        # Shots hitting asteroids
+        for shot, player, distance in list(self.shots.values()):
+            a = self.get_asteroid_hit(grid, shot, 0)
+            if a is not None:
+                del self.shots[shot.id]
+                self.remove_entity(shot)
+                del self.asteroids[a.id]
+                self.remove_entity(a)
+                # Points for both halves, like in the game
+                player.score += 2 * (my_game.ASTEROIDS_MAX_POINTS // a.size)
+
+                # Split off two asteroids going left or right
+                if a.size > 1:
+                    for direction in [-1, 1]:
+                        new_angle = shot.angle + 90 + direction * random.randint(0, my_game.ASTEROIDS_MAX_SPLIT_ANGLE)
+                        self.add_asteroid(a.size - 1, a.center_x, a.center_y, new_angle)
+
+        # Players hitting asteroids
+        for player in self.players:
+            a = self.get_asteroid_hit(grid, player.entity, SERVER_PLAYER_RADIUS)
+            if a is not None:
+                del self.asteroids[a.id]
+                self.remove_entity(a)
+                self.player_dies(player)
+
+        if not self.asteroids:
+            self.level += 1
+            self.spawn_level()
+
+        self.tick_times.append(perf_counter() - start)
+
+    def send_state(self):
+        """
+        Send changes to all players. New players get all entities.
+        """
+        # Made once and sent to every player
+        changes = b"".join(self.entities[i].pack() for i in self.changed)
+        removals = b"".join(REMOVED.pack(i) for i in self.removed)
+
+        for player in self.players:
+            # Sending does not wait for slow clients, as that would hold up everyone else.
+            # A client not reading its data is disconnected before it uses too much memory
+            if player.writer.is_closing():
+                continue
+            if player.writer.transport.get_write_buffer_size() > SERVER_MAX_BUFFERED_BYTES:
+                # close() would wait until the data is sent
+                player.writer.transport.abort()
+                continue
+
+            if player.has_full_state:
+                entity_count, body = len(self.changed), changes + removals
+                removed_count = len(self.removed)
+            else:
+                entity_count, body = len(self.entities), b"".join(e.pack() for e in self.entities.values())
+                removed_count = 0
+                player.has_full_state = True
+
+            header = STATE_HEADER.pack(
+                MESSAGE_STATE, self.tick, player.last_input, player.score, player.lives,
+                self.level, entity_count, removed_count
+            )
+            message = MESSAGE_LENGTH.pack(len(header) + len(body)) + header + body
+            player.writer.write(message)
+            player.bytes_sent += len(message)
+
+        self.changed.clear()
+        self.removed.clear()
+
+    async def handle_client(self, reader, writer):
+        player = self.add_player(writer)
+        writer.write(MESSAGE_LENGTH.pack(WELCOME.size) + WELCOME.pack(MESSAGE_WELCOME, player.entity.id))
+
+        try:
+            while True:
+                length, = MESSAGE_LENGTH.unpack(await reader.readexactly(MESSAGE_LENGTH.size))
+                # Clients only send inputs. Anything else is a broken client
+                if length != INPUT.size:
+                    break
+                message_type, number, rotate, thrust, fire = INPUT.unpack(await reader.readexactly(length))
+                # The server decides what players can do. A rotation of 100 would turn 100 times as fast
+                if message_type != MESSAGE_INPUT or rotate not in (-1, 0, 1) or thrust not in (0, 1) or fire not in (0, 1):
+                    break
+                player.inputs.append((number, rotate, thrust == 1, fire == 1))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.remove_player(player)
+            writer.close()
+
+    async def run(self, host=SERVER_HOST, port=SERVER_PORT, ticks=None):
+        """
+        Accept clients and run the game, forever or for a number of ticks
+        """
+        server = await asyncio.start_server(self.handle_client, host, port)
+
+        async with server:
+            while ticks is None or self.tick < ticks:
+                start = perf_counter()
+                self.update()
+                self.send_state()
+                await asyncio.sleep(max(0, 1 / SERVER_TICK_RATE - (perf_counter() - start)))
+
+            # Disconnect everyone when the game is over
+            for player in self.players:
+                player.writer.close()
+
+
+class GameClient():
+    """
+    Connects to a GameServer. Moves its own player right away when input is given,
+    and corrects it when the server has used the input.
+    """
+    def __init__(self):
+        self.player_id = None
+        self.tick = 0
+        self.score = 0
+        self.lives = 0
+        self.level = 0
+
+        # Latest known state of every entity, and the tick it is from
+        self.entities = {}
+
+        # Own player, moved by the inputs not used by the server yet
+        self.predicted = None
+        self.next_input = 1
+        self.pending_inputs = deque()
+
+        self.bytes_received = 0
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host=SERVER_HOST, port=SERVER_PORT):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    def send_input(self, rotate, thrust, fire):
+        """
+        Send input for the next tick to the server, and move own player right away
+        """
+        number = self.next_input
+        self.next_input += 1
+        self.pending_inputs.append((number, rotate, thrust))
+        self.writer.write(MESSAGE_LENGTH.pack(INPUT.size) + INPUT.pack(MESSAGE_INPUT, number, rotate, thrust, fire))
+
+        if self.predicted is not None:
+            apply_input(self.predicted, rotate, thrust)
+            self.predicted.move()
+
+    def get_entity(self, entity_id, tick=None):
+        """
+        Returns where an entity is at tick, worked out from the last state the server sent
+        """
+        entity, sent_tick = self.entities[entity_id]
+        moved = Entity(
+            entity.kind, entity.center_x, entity.center_y, entity.change_x, entity.change_y,
+            entity.angle, entity.change_angle, entity.size
+        )
+        moved.id = entity.id
+        moved.move((self.tick if tick is None else tick) - sent_tick)
+        return moved
+
+    def read_state(self, data):
+        message_type, self.tick, last_input, self.score, self.lives, self.level, entity_count, removed_count = \
+            STATE_HEADER.unpack_from(data)
+
+        offset = STATE_HEADER.size
+        for i in range(entity_count):
+            values = ENTITY.unpack_from(data, offset)
+            offset += ENTITY.size
+            entity = Entity(values[1], *values[3:], size=values[2])
+            entity.id = values[0]
+            self.entities[entity.id] = (entity, self.tick)
+
+        for i in range(removed_count):
+            entity_id, = REMOVED.unpack_from(data, offset)
+            offset += REMOVED.size
+            self.entities.pop(entity_id, None)
+
+        # Start from where the server says own player is, and redo the inputs it has not used yet
+        while self.pending_inputs and self.pending_inputs[0][0] <= last_input:
+            self.pending_inputs.popleft()
+        if self.player_id in self.entities:
+            self.predicted = self.get_entity(self.player_id)
+            for number, rotate, thrust in self.pending_inputs:
+                apply_input(self.predicted, rotate, thrust)
+                self.predicted.move()
+
+    async def receive(self):
+        """
+        Read messages from the server until the connection is closed
+        """
+        try:
+            while True:
+                length, = MESSAGE_LENGTH.unpack(await self.reader.readexactly(MESSAGE_LENGTH.size))
+                data = await self.reader.readexactly(length)
+                self.bytes_received += MESSAGE_LENGTH.size + length
+
+                if data[0] == MESSAGE_WELCOME:
+                    message_type, self.player_id = WELCOME.unpack(data)
+                elif data[0] == MESSAGE_STATE:
+                    self.read_state(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def close(self):
+        self.writer.close()
+
+
+if __name__ == "__main__":
+    print("Server running on {}:{}".format(SERVER_HOST, SERVER_PORT))
+    asyncio.run(GameServer().run())
@@ -0,0 +1,131 @@
+"""
+Load test of the highscore API. Starts a local highscore_server, unless --url is given,
+and sends requests from many threads like games showing and posting highscores.
+
+    python highscore_load_test.py --threads 8 --seconds 10
+"""
+
+import argparse
+import random
+import threading
+from time import perf_counter
+
+import requests
+
+import highscore_server
+
+GAME_KEY = "LoadTestGame"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def seed(api_url, headers, player_count, score_count):
+    """
+    Add players and scores, and return the keys of the players
+    """
+    session = requests.Session()
+    player_keys = [
+        session.post(api_url + "v1/players", json={"name": "Player{}".format(i)}, headers=headers).json()["key"]
+        for i in range(player_count)
+    ]
+    for i in range(score_count):
+        session.post(
+            api_url + f"v1/games/{GAME_KEY}/scores",
+            json={"player_key": random.choice(player_keys), "score": random.randint(0, 100000)},
+            headers=headers
+        )
+    return player_keys
+
+
+def worker(api_url, headers, player_keys, seconds, post_share, latencies, lock):
+    """
+    Send requests until time is up. Most requests get the highscores, some post a score
+    """
+    session = requests.Session()
+    etag = None
+    my_latencies = {"scores": [], "players": [], "post": []}
+    end = perf_counter() + seconds
+
+    while perf_counter() < end:
+        start = perf_counter()
+
+        if random.random() < post_share:
+            kind = "post"
+            session.post(
+                api_url + f"v1/games/{GAME_KEY}/scores",
+                json={"player_key": random.choice(player_keys), "score": random.randint(0, 100000)},
+                headers=headers
+            )
+        else:
+            # Get the scores, then the names of their players, like the game does
+            kind = "scores"
+            r = session.get(
+                api_url + f"v1/games/{GAME_KEY}/scores?limit=10",
+                headers={"If-None-Match": etag} if etag else {}
+            )
+            if r.status_code == 200:
+                etag = r.headers.get("ETag")
+                keys = ",".join(score["player_key"] for score in r.json()["_items"])
+                my_latencies[kind].append(perf_counter() - start)
+
+                kind = "players"
+                start = perf_counter()
+                session.get(api_url + f"v1/players?keys={keys}")
+
+        my_latencies[kind].append(perf_counter() - start)
+
+    with lock:
+        for kind, values in my_latencies.items():
+            latencies[kind].extend(values)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the highscore API")
+    parser.add_argument("--url", default=None, help="API to test. Starts a local server if not given")
+    parser.add_argument("--access-token", default="LoadTestToken")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--players", type=int, default=100)
+    parser.add_argument("--scores", type=int, default=1000)
+    parser.add_argument("--post-share", type=float, default=0.05, help="Share of requests posting a score")
+    args = parser.parse_args()
+
+    api_url = args.url
+    if api_url is None:
+        server = highscore_server.make_server(port=0, access_token=args.access_token)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        api_url = "http://{}:{}/".format(*server.server_address)
+
+    headers = {"X-Access-Token": args.access_token}
+    player_keys = seed(api_url, headers, args.players, args.scores)
+
+    latencies = {"scores": [], "players": [], "post": []}
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(
+            target=worker,
+            args=(api_url, headers, player_keys, args.seconds, args.post_share, latencies, lock)
+        )
+        for i in range(args.threads)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    total = sum(len(values) for values in latencies.values())
+    print("{} requests in {} s from {} threads: {:.0f} requests/s".format(
+        total, args.seconds, args.threads, total / args.seconds
+    ))
+    for kind, values in latencies.items():
+        if values:
+            print("{:<8} {:>7} requests   p50 {:6.2f} ms   p95 {:6.2f} ms   p99 {:6.2f} ms".format(
+                kind,
+                len(values),
+                percentile(values, 50) * 1000,
+                percentile(values, 95) * 1000,
+                percentile(values, 99) * 1000
+            ))
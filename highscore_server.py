@@ -0,0 +1,256 @@
+"""
+Local version of the highscore API the game uses, for testing without internet.
+
+Start it:
+
+    python highscore_server.py --port 8000 --access-token MySecretToken
+
+and set api-url in highscores_config.yml to "http://127.0.0.1:8000/".
+
+Endpoints:
+
+    GET  v1/games/{game_key}/scores?limit=10   Best scores of a game
+    POST v1/games/{game_key}/scores            Add a score: {"player_key": ..., "score": ...}
+    GET  v1/players/{player_key}               A player
+    GET  v1/players?keys=key1,key2             Many players at once
+    POST v1/players                            Add a player: {"name": ...}
+
+POST requests need the header X-Access-Token if the server has an access token.
+Score lists are cached and sent with an ETag, so clients can ask with If-None-Match.
+"""
+
+import argparse
+import hashlib
+import json
+import secrets
+import sqlite3
+import string
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+HIGHSCORE_HOST = "127.0.0.1"
+HIGHSCORE_PORT = 8000
+# Scores sent when the client does not ask for a limit, and the most it can ask for
+HIGHSCORE_DEFAULT_LIMIT = 10
+HIGHSCORE_MAX_LIMIT = 100
+# Characters in keys of players and scores
+HIGHSCORE_KEY_LENGTH = 12
+# Score lists kept in the cache. Clients choose the game key and limit, so the least recently used are dropped
+HIGHSCORE_CACHE_SIZE = 1000
+
+
+def make_key():
+    return "".join(secrets.choice(string.ascii_lowercase + string.digits) for i in range(HIGHSCORE_KEY_LENGTH))
+
+
+class HighscoreStore():
+    """
+    Players and scores in an SQLite database, with the best scores of each game cached
+    """
+    def __init__(self, path=":memory:", cache_size=HIGHSCORE_CACHE_SIZE):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS players (key TEXT PRIMARY KEY, name TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS scores (
+                    key TEXT PRIMARY KEY,
+                    game_key TEXT NOT NULL,
+                    player_key TEXT NOT NULL,
+                    score INTEGER NOT NULL
+                );
+                -- Best scores of a game are found without sorting all scores
+                CREATE INDEX IF NOT EXISTS scores_by_game ON scores (game_key, score DESC);
+            """)
+
+        # (game_key, limit) -> (etag, json body), least recently used first. Forgotten when a game gets a new score
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def get_scores(self, game_key, limit):
+        """
+        Returns (etag, json body) with the best scores of a game
+        """
+        with self.lock:
+            cached = self.cache.get((game_key, limit))
+            if cached is not None:
+                self.cache.move_to_end((game_key, limit))
+                return cached
+
+            rows = self.connection.execute(
+                "SELECT key, player_key, score FROM scores WHERE game_key = ? ORDER BY score DESC LIMIT ?",
+                (game_key, limit)
+            ).fetchall()
+
+            body = json.dumps({
+                "_items": [{"key": key, "player_key": player_key, "score": score} for key, player_key, score in rows]
+            }).encode()
+            # Made from the body, so it stays right when the server is restarted with the same database
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+            self.cache[(game_key, limit)] = (etag, body)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return etag, body
+
+    def add_score(self, game_key, player_key, score):
+        key = make_key()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO scores (key, game_key, player_key, score) VALUES (?, ?, ?, ?)",
+                (key, game_key, player_key, score)
+            )
+            # The cached lists of this game are old now
+            for cache_key in [k for k in self.cache if k[0] == game_key]:
+                del self.cache[cache_key]
+        return {"key": key, "game_key": game_key, "player_key": player_key, "score": score}
+
+    def get_players(self, player_keys):
+        """
+        Returns the players with the keys. Unknown keys are left out
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT key, name FROM players WHERE key IN ({})".format(", ".join("?" * len(player_keys))),
+                player_keys
+            ).fetchall()
+        return [{"key": key, "name": name} for key, name in rows]
+
+    def add_player(self, name):
+        key = make_key()
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO players (key, name) VALUES (?, ?)", (key, name))
+        return {"key": key, "name": name}
+
+
+class HighscoreHandler(BaseHTTPRequestHandler):
+    """
+    Answers requests to the API. The store and access token are set on the server
+    """
+    # Keep connections open between requests
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately. Without this, the body waits for the client's ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        # Printing every request would slow the server down
+        pass
+
+    def send_json(self, status, body, headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        """
+        Returns the json in the body, or None if the body or its Content-Length is not valid
+        """
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        # The body can't be skipped without its length, so the connection is closed after the answer.
+        # A negative length would read until the client closes the connection
+        if length < 0:
+            self.close_connection = True
+            return None
+
+        try:
+            return json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        query = parse_qs(url.query)
+        store = self.server.store
+
+        if len(parts) == 4 and parts[:2] == ["v1", "games"] and parts[3] == "scores":
+            try:
+                limit = int(query.get("limit", [HIGHSCORE_DEFAULT_LIMIT])[0])
+            except ValueError:
+                limit = 0
+            # SQLite reads a negative limit as no limit
+            if not 1 <= limit <= HIGHSCORE_MAX_LIMIT:
+                return self.send_json(400, {"error": "limit must be from 1 to {}".format(HIGHSCORE_MAX_LIMIT)})
+
+            etag, body = store.get_scores(parts[2], limit)
+
+            # The client already has this list
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            return self.send_json(200, body, {"ETag": etag})
+
+        if len(parts) == 3 and parts[:2] == ["v1", "players"]:
+            players = store.get_players([parts[2]])
+            if not players:
+                return self.send_json(404, {"error": "player not found"})
+            return self.send_json(200, players[0])
+
+        if parts == ["v1", "players"] and "keys" in query:
+            keys = query["keys"][0].split(",")[:HIGHSCORE_MAX_LIMIT]
+            return self.send_json(200, {"_items": store.get_players(keys)})
+
+        self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        store = self.server.store
+
+        if self.server.access_token is not None and self.headers.get("X-Access-Token") != self.server.access_token:
+            return self.send_json(401, {"error": "wrong access token"})
+
+        data = self.read_json()
+        if not isinstance(data, dict):
+            return self.send_json(400, {"error": "body must be a json object"})
+
+        if len(parts) == 4 and parts[:2] == ["v1", "games"] and parts[3] == "scores":
+            if not isinstance(data.get("score"), int) or not store.get_players([str(data.get("player_key"))]):
+                return self.send_json(400, {"error": "needs a known player_key and a whole number score"})
+            return self.send_json(201, store.add_score(parts[2], data["player_key"], data["score"]))
+
+        if parts == ["v1", "players"]:
+            if not isinstance(data.get("name"), str) or not data["name"]:
+                return self.send_json(400, {"error": "needs a name"})
+            return self.send_json(201, store.add_player(data["name"]))
+
+        self.send_json(404, {"error": "not found"})
+
+
+def make_server(host=HIGHSCORE_HOST, port=HIGHSCORE_PORT, database=":memory:", access_token=None):
+    """
+    Returns a server ready to serve_forever()
+    """
+    server = ThreadingHTTPServer((host, port), HighscoreHandler)
+    server.daemon_threads = True
+    server.store = HighscoreStore(database)
+    server.access_token = access_token
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local highscore API")
+    parser.add_argument("--host", default=HIGHSCORE_HOST)
+    parser.add_argument("--port", type=int, default=HIGHSCORE_PORT)
+    parser.add_argument("--database", default="highscores.db")
+    parser.add_argument("--access-token", default=None)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.database, args.access_token)
+    print("Highscore API running on http://{}:{}/".format(args.host, args.port))
+    server.serve_forever()
@@ -8,10 +8,18 @@ Artwork from https://kenney.nl/assets/space-shooter-redux
 
 import arcade
 import arcade.gui
-from math import sin, cos, pi, sqrt, inf
+from math import sin, cos, pi, sqrt, inf, nan, isnan
 import random
-from time import sleep
-from typing import Tuple
+from time import sleep, perf_counter
+from collections import deque
+from array import array
+import struct
+import sys
+import logging
+import gc
+import csv
+import tracemalloc
+from typing import Tuple, NamedTuple
 from pyglet.math import Vec2
 import requests
 import simplejson
@@ -24,11 +32,20 @@ BACKGROUND_COLOR = arcade.color.BLACK
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
 
+# Size of the world. The camera follows the player when the world is bigger than the screen
+WORLD_WIDTH = SCREEN_WIDTH
+WORLD_HEIGHT = SCREEN_HEIGHT
+
+# Asteroids are kept in square chunks of the world. Only chunks near the screen are drawn and updated
+CHUNK_SIZE = 800
+# Chunks this far outside of the screen are still updated
+CHUNK_WAKE_DISTANCE = 200
+
 # Variables controlling the player
 PLAYER_LIVES = 3
 PLAYER_THRUST = 0.2
-PLAYER_START_X = SCREEN_WIDTH / 2
-PLAYER_START_Y = SCREEN_HEIGHT / 2
+PLAYER_START_X = WORLD_WIDTH / 2
+PLAYER_START_Y = WORLD_HEIGHT / 2
 PLAYER_SHOT_SPEED = 4
 PLAYER_SHOT_RANGE = max(SCREEN_HEIGHT, SCREEN_WIDTH) * 0.5
 PLAYER_ROTATE_SPEED = 5
@@ -44,10 +61,21 @@ UFO_SPAWN_TIME_MIN = 80
 ASTEROIDS_TIMER_SECONDS = inf  # inf == spawn all asteroids at the same time
 ASTEROIDS_SPEED = 1
 ASTEROIDS_PER_LEVEL = 5
+# More asteroids on every level, but never more than ASTEROIDS_MAX_PER_LEVEL
+ASTEROIDS_EXTRA_PER_LEVEL = 2
+ASTEROIDS_MAX_PER_LEVEL = 2000
+# Size of the buffers of the asteroid list. Lists grow when they are full, so leave room for splits
+ASTEROIDS_CAPACITY = ASTEROIDS_MAX_PER_LEVEL * 2
+# Asteroids are spawned over several frames, so a new level does not freeze the game
+ASTEROIDS_SPAWN_PER_FRAME = 50
+# Max time to spend spawning asteroids every frame
+ASTEROIDS_SPAWN_BUDGET_SECONDS = 0.002
 ASTEROIDS_DEFAULT_SIZE = 4
 ASTEROIDS_SCALE = 0.4
 ASTEROIDS_MIN_SPAWN_DIST = 150
 ASTEROIDS_MAX_SPLIT_ANGLE = 45
+# Hit boxes of spinning asteroids are rotated in steps of this many degrees
+ASTEROIDS_HIT_BOX_ANGLE_STEP = 1
 # the points you get for the smallest size (1) asteroids: less points for big asteroids.
 ASTEROIDS_MAX_POINTS = 100
 
@@ -58,9 +86,16 @@ with open("highscores_config.yml", "r") as f:
     API_GAME_KEY = config["api-game-key"]
     API_ACCESS_TOKEN = config["api-access-token"]
 
+# Scores saved in highscores.yml. Lower scores are left out, so the file does not grow forever
+HIGHSCORES_KEEP = 100
+
 # Play sound?
 SOUND_ON = True
 
+# Most sounds to start in one update. Fewer when the game is running slow
+SOUND_MAX_VOICES = 4
+sound_voices_left = SOUND_MAX_VOICES
+
 GAME_PAUSE_LENGTH_SECONDS = 2
 
 FIRE_KEY = arcade.key.SPACE
@@ -73,6 +108,97 @@ SHAKE_DAMPING = 0.9
 
 FONT_NAME = "Kenney Blocks"
 
+# Show the number of draw calls every frame
+SHOW_DRAW_CALLS = False
+
+# Save states. Bump the version when the fields below change
+SNAPSHOT_MAGIC = b"ASTR"
+SNAPSHOT_VERSION = 1
+# Magic, version and the number of asteroids, UFOs, shots and asteroids waiting to spawn.
+# Padded to 24 bytes, so the doubles after it are aligned
+SNAPSHOT_HEADER = struct.Struct("<4sHxxIIII")
+# Attributes saved for the game and each kind of sprite. All are saved as little-endian doubles
+SNAPSHOT_GAME_FIELDS = (
+    "level", "shots_fired", "shots_hit", "shots_accuracy", "is_paused",
+    "paused_time_left", "UFO_spawn_timer", "asteroids_timer_seconds"
+)
+SNAPSHOT_PLAYER_FIELDS = ("center_x", "center_y", "change_x", "change_y", "angle", "alpha", "lives", "score")
+SNAPSHOT_ASTEROID_FIELDS = ("size", "center_x", "center_y", "change_x", "change_y", "angle", "change_angle")
+SNAPSHOT_UFO_FIELDS = ("scale", "value", "center_x", "center_y", "change_x", "change_y", "angle", "dir_timer")
+SNAPSHOT_SHOT_FIELDS = ("center_x", "center_y", "change_x", "change_y", "angle", "distance_traveled")
+# Fields which are not floats
+SNAPSHOT_FIELD_TYPES = {
+    "level": int, "shots_fired": int, "shots_hit": int, "is_paused": bool,
+    "alpha": int, "lives": int, "score": int, "size": int, "value": int
+}
+# Asteroids waiting to spawn: size, center_x, center_y, angle. None is saved as NaN
+SNAPSHOT_SPAWN_FIELDS = 4
+
+# Effects (particles, camera shake, sounds) are reduced when frames take too long.
+# The game itself always runs the same.
+QUALITY_FRAME_BUDGET_SECONDS = 1 / 60
+# Number of frames to average the frame time over
+QUALITY_WINDOW_FRAMES = 60
+# Lower quality when frames take this much of the budget, raise it again below QUALITY_RAISE_AT
+QUALITY_LOWER_AT = 1.2
+QUALITY_RAISE_AT = 0.9
+QUALITY_STEP = 0.25
+QUALITY_MIN = 0.25
+
+# Game events
+EVENT_SHOT_FIRED = "shot_fired"
+EVENT_SHOT_EXPIRED = "shot_expired"
+EVENT_ASTEROID_SPLIT = "asteroid_split"
+EVENT_UFO_KILLED = "ufo_killed"
+EVENT_PLAYER_DIED = "player_died"
+EVENT_LEVEL_CLEARED = "level_cleared"
+
+# Input
+# Stick values closer to 0 than this count as 0
+INPUT_DEAD_ZONE = 0.15
+INPUT_THRUST_BUTTON = 0
+INPUT_FIRE_BUTTON = 1
+
+# Seconds between log messages of the same kind. Messages in between are counted, not written
+LOG_INTERVAL_SECONDS = 1.0
+
+logger = logging.getLogger("asteroids")
+
+# Memory tracking for long sessions. Samples are written to MEMORY_LOG_FILE
+MEMORY_TRACKING = False
+MEMORY_SAMPLE_SECONDS = 60
+MEMORY_LOG_FILE = "memory.csv"
+# Object types counted in every sample. An object is counted in the first category it fits
+MEMORY_CATEGORIES = (
+    ("particles", arcade.Particle),
+    ("sprites", arcade.Sprite),
+    ("sprite_lists", arcade.SpriteList),
+    ("textures", arcade.Texture),
+    ("emitters", arcade.Emitter),
+)
+# Samples from the first seconds are not used for growth. Caches and the texture atlas fill up then
+MEMORY_WARMUP_SECONDS = 600
+# Most each category may grow per hour of play, once warmed up
+MEMORY_MAX_GROWTH_PER_HOUR = {
+    "traced_kb": 1024,
+    "particles": 100,
+    "sprites": 50,
+    "sprite_lists": 2,
+    "textures": 2,
+    "emitters": 2,
+}
+
+
+def play_sound(sound):
+    """
+    Play sound, unless sound is off or too many sounds have started in this update
+    """
+    global sound_voices_left
+
+    if SOUND_ON is True and sound is not None and sound_voices_left > 0:
+        sound.play()
+        sound_voices_left -= 1
+
 
 def api_get_highscores(api_url, game_key, limit):
 	"""
@@ -93,21 +219,158 @@ def api_get_highscores(api_url, game_key, limit):
 
 	return player_highscores
 
+def asteroids_for_level(level):
+    """
+    Returns the number of asteroids to spawn on a level
+    """
+    return min(ASTEROIDS_PER_LEVEL + (level - 1) * ASTEROIDS_EXTRA_PER_LEVEL, ASTEROIDS_MAX_PER_LEVEL)
+
+
+def get_spawn_position(player):
+    """
+    Returns a random position at least ASTEROIDS_MIN_SPAWN_DIST away from the player,
+    also around the edges of the world. The position is picked anywhere in the world,
+    and moved to the other side of the world if it is too close, so no retries are needed.
+    """
+    # Offset from the player. Half a world each way covers the whole world once
+    dx = random.uniform(-WORLD_WIDTH / 2, WORLD_WIDTH / 2)
+    dy = random.uniform(-WORLD_HEIGHT / 2, WORLD_HEIGHT / 2)
+
+    # Half a world away in both directions is the farthest place from the player. Positions
+    # moved there are far enough as long as half the world's diagonal is twice ASTEROIDS_MIN_SPAWN_DIST
+    if dx * dx + dy * dy < ASTEROIDS_MIN_SPAWN_DIST ** 2:
+        dx += WORLD_WIDTH / 2
+        dy += WORLD_HEIGHT / 2
+
+    # Wrap position to the world like everything else in the game
+    center_x = (player.center_x + dx) % WORLD_WIDTH
+    center_y = (player.center_y + dy) % WORLD_HEIGHT
+
+    return center_x, center_y
+
+
+def empty_sprite_list(sprite_list):
+    """
+    Remove all sprites from sprite_list, and from the other lists they are in.
+    Unlike SpriteList.clear() the buffers of the list are kept, so they don't have to be made again.
+    """
+    for sprite in sprite_list.sprite_list:
+        sprite.sprite_lists.remove(sprite_list)
+        # Shots and UFOs are also in ships_list. That list is short, so they are removed one at a time
+        for other in list(sprite.sprite_lists):
+            other.remove(sprite)
+
+    # What SpriteList.clear() does in arcade 2.6, without making new buffers. Removing the
+    # sprites one at a time would move the whole index buffer for every sprite.
+    # New sprites get slots from the start again, and their data overwrites the old data
+    sprite_list.sprite_list = []
+    sprite_list.sprite_slot = {}
+    sprite_list._sprite_buffer_slots = 0
+    sprite_list._sprite_buffer_free_slots.clear()
+    sprite_list._sprite_index_slots = 0
+    sprite_list._sprite_index_changed = True
+    sprite_list._deferred_sprites = set()
+    if sprite_list.spatial_hash:
+        sprite_list.spatial_hash = type(sprite_list.spatial_hash)(cell_size=sprite_list._spatial_hash_cell_size)
+
+
+def count_objects():
+    """
+    Returns the number of live objects in each of MEMORY_CATEGORIES
+    """
+    # Sprites and their lists refer to each other, so dead ones wait for the garbage collector
+    gc.collect()
+
+    counts = {name: 0 for name, object_type in MEMORY_CATEGORIES}
+    for o in gc.get_objects():
+        for name, object_type in MEMORY_CATEGORIES:
+            if isinstance(o, object_type):
+                counts[name] += 1
+                break
+    return counts
+
+
+def get_game_textures():
+    """
+    Returns all textures used by sprites and particles in the game
+    """
+    textures = [
+        arcade.load_texture(filename)
+        for filename in [
+            "images/playerShip2_red.png",
+            "images/Lasers/laserBlue01.png",
+            "images/Meteors/meteorBrown_big1.png",
+            "images/ufoGreen.png",
+            "images/Icons/audioOff.png",
+            "images/Icons/audioOn.png",
+        ]
+    ]
+    return textures + StoppableEmitter.textures + [GameView.explosion_texture]
+
+
+def pack_sprites(sprites, fields):
+    """
+    Returns the values of fields for all sprites, one sprite after the other
+    """
+    return array("d", [getattr(sprite, field) for sprite in sprites for field in fields])
+
+
+def unpack_sprites(sprites, values, offset, fields):
+    """
+    Set fields of sprites from values, starting at offset.
+    Returns the offset after the last value used
+    """
+    # Values are saved as doubles. Values of each field are read as a column of all sprites
+    count = len(sprites)
+    columns = [values[offset + i:offset + count * len(fields):len(fields)] for i in range(len(fields))]
+    setters = [(field, SNAPSHOT_FIELD_TYPES.get(field, float)) for field in fields]
+
+    # center_x and center_y are set together as position, so sprite lists are updated once instead of twice
+    if "center_x" in fields and fields.index("center_y") == fields.index("center_x") + 1:
+        i = fields.index("center_x")
+        columns[i:i + 2] = [zip(columns[i], columns[i + 1])]
+        setters[i:i + 2] = [("position", tuple)]
+
+    for sprite, row in zip(sprites, zip(*columns)):
+        for (field, field_type), value in zip(setters, row):
+            setattr(sprite, field, field_type(value))
+
+    return offset + count * len(fields)
+
+
+def reuse_sprites(sprites, count, make_sprite):
+    """
+    Returns (count sprites, the new ones among them). The sprites are reused, and
+    make_sprite() is called if there are too few. Sprites not needed are removed
+    from their lists. New sprites are not in any list yet
+    """
+    sprites = list(sprites)
+    for sprite in sprites[count:]:
+        sprite.remove_from_sprite_lists()
+    del sprites[count:]
+
+    new_sprites = [make_sprite() for i in range(count - len(sprites))]
+    return sprites + new_sprites, new_sprites
+
+
 class Asteroid(arcade.Sprite):
 
+    # Rotated and scaled hit boxes shared by all asteroids, by (texture, size, angle step).
+    # Each is kept with its extents (left, bottom, right, top) relative to the center
+    hit_box_cache = {}
+
     def __init__(self, size, player, center_x=None, center_y=None, angle=None):
 
         # If no position given, spawn at random position not on Player
         if center_x is None and center_y is None:
-            # If asteroid position not legal, give new position
-            while True:
-                center_x = random.randint(0, SCREEN_WIDTH)
-                center_y = random.randint(0, SCREEN_HEIGHT)
-                if arcade.get_distance(center_x, center_y, player.center_x, player.center_y) > ASTEROIDS_MIN_SPAWN_DIST:
-                    break
+            center_x, center_y = get_spawn_position(player)
 
         self.size = size
 
+        # The hit box from hit_box_cache last used, with the angle and size it was looked up for
+        self.rotated_hit_box = None
+        self.rotated_hit_box_key = None
+
         super().__init__(
             center_x = center_x,
             center_y = center_y,
@@ -128,6 +391,232 @@ class Asteroid(arcade.Sprite):
         self.center_y += self.change_y
         self.angle += self.change_angle
 
+    def get_rotated_hit_box(self):
+        """
+        Returns the rotated and scaled hit box, and its extents, from the hit box cache.
+        The hit box is rotated and scaled the first time an asteroid needs it at this angle.
+        """
+        if self.rotated_hit_box_key == (self.angle, self.size):
+            return self.rotated_hit_box
+
+        angle_step = round(self.angle / ASTEROIDS_HIT_BOX_ANGLE_STEP) % round(360 / ASTEROIDS_HIT_BOX_ANGLE_STEP)
+        key = (self.texture.name, self.size, angle_step)
+
+        cached = Asteroid.hit_box_cache.get(key)
+        if cached is None:
+            points = []
+            for x, y in self.hit_box:
+                x, y = arcade.rotate_point(x, y, 0, 0, angle_step * ASTEROIDS_HIT_BOX_ANGLE_STEP)
+                points.append((x * self.scale, y * self.scale))
+            x_points = [x for x, y in points]
+            y_points = [y for x, y in points]
+            cached = points, (min(x_points), min(y_points), max(x_points), max(y_points))
+            Asteroid.hit_box_cache[key] = cached
+
+        self.rotated_hit_box = cached
+        self.rotated_hit_box_key = (self.angle, self.size)
+        return cached
+
+    def get_adjusted_hit_box(self):
+        """
+        Returns the hit box moved to the position of the asteroid.
+        The rotated hit box is looked up instead of being calculated every frame.
+        """
+        # Arcade forgets the hit box every time the asteroid moves or turns
+        if self._point_list_cache is not None:
+            return self._point_list_cache
+
+        points, extents = self.get_rotated_hit_box()
+        self._point_list_cache = [(x + self.center_x, y + self.center_y) for x, y in points]
+
+        return self._point_list_cache
+
+    # The sides are read from the extents of the cached hit box. Arcade builds the
+    # moved hit box for every side, and screen_wrap reads all four every frame
+    @property
+    def left(self):
+        return self.center_x + self.get_rotated_hit_box()[1][0]
+
+    @left.setter
+    def left(self, amount):
+        self.center_x += amount - self.left
+
+    @property
+    def bottom(self):
+        return self.center_y + self.get_rotated_hit_box()[1][1]
+
+    @bottom.setter
+    def bottom(self, amount):
+        self.center_y += amount - self.bottom
+
+    @property
+    def right(self):
+        return self.center_x + self.get_rotated_hit_box()[1][2]
+
+    @right.setter
+    def right(self, amount):
+        self.center_x += amount - self.right
+
+    @property
+    def top(self):
+        return self.center_y + self.get_rotated_hit_box()[1][3]
+
+    @top.setter
+    def top(self, amount):
+        self.center_y += amount - self.top
+
+
+class SpriteChunks():
+    """
+    Sprites sorted into square chunks of the world. Every chunk has its own SpriteList,
+    so chunks far away from the screen can be skipped when drawing and updating.
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE, capacity=100):
+        self.chunk_size = chunk_size
+
+        # Number of chunks across and up the world
+        self.columns = max(1, int(-(-WORLD_WIDTH // chunk_size)))
+        self.rows = max(1, int(-(-WORLD_HEIGHT // chunk_size)))
+
+        # One chunk gets all the capacity. Many chunks share it, with extra as sprites are not spread evenly.
+        # Bigger buffers make removing sprites slower, as the index buffer is moved on every removal
+        chunk_count = self.columns * self.rows
+        chunk_capacity = capacity if chunk_count == 1 else max(100, 2 * capacity // chunk_count)
+
+        # SpriteList for every (column, row) of the world. They are made once and reused
+        self.chunks = {}
+        # SpriteList -> (left, bottom, right, top) of its chunk. Edge chunks reach outside of the world
+        self.bounds = {}
+        for column in range(self.columns):
+            for row in range(self.rows):
+                sprite_list = arcade.SpriteList(capacity=chunk_capacity)
+                self.chunks[(column, row)] = sprite_list
+                self.bounds[sprite_list] = (
+                    column * chunk_size if column > 0 else -inf,
+                    row * chunk_size if row > 0 else -inf,
+                    (column + 1) * chunk_size if column < self.columns - 1 else inf,
+                    (row + 1) * chunk_size if row < self.rows - 1 else inf
+                )
+
+    def get_key(self, x, y):
+        """
+        Returns (column, row) of the chunk at position x, y
+        """
+        # Sprites just outside of the world (before wrapping) belong to the chunk at the edge
+        column = min(self.columns - 1, max(0, int(x // self.chunk_size)))
+        row = min(self.rows - 1, max(0, int(y // self.chunk_size)))
+        return column, row
+
+    def append(self, sprite):
+        """
+        Add sprite to the chunk it is in
+        """
+        self.chunks[self.get_key(sprite.center_x, sprite.center_y)].append(sprite)
+
+    def __len__(self):
+        return sum(len(c) for c in self.chunks.values())
+
+    def __iter__(self):
+        for c in self.chunks.values():
+            yield from c
+
+    def empty(self):
+        """
+        Remove all sprites, but keep the lists
+        """
+        for c in self.chunks.values():
+            empty_sprite_list(c)
+
+    def get_lists(self, left, bottom, right, top):
+        """
+        Returns the SpriteLists of the chunks touching the rectangle
+        """
+        first_column, first_row = self.get_key(left, bottom)
+        last_column, last_row = self.get_key(right, top)
+
+        return [
+            self.chunks[(column, row)]
+            for column in range(first_column, last_column + 1)
+            for row in range(first_row, last_row + 1)
+        ]
+
+    def move_sprites(self, lists):
+        """
+        Move sprites in lists to the chunk they are in now
+        """
+        # Sprites can not leave the only chunk
+        if len(self.chunks) == 1:
+            return
+
+        for sprite_list in lists:
+            left, bottom, right, top = self.bounds[sprite_list]
+            leaving = [
+                sprite for sprite in sprite_list
+                if not (left <= sprite.center_x < right and bottom <= sprite.center_y < top)
+            ]
+            for sprite in leaving:
+                sprite_list.remove(sprite)
+                self.append(sprite)
+
+
+class AsteroidSpawner():
+    """
+    Queue of asteroids waiting to be spawned. Only a few are spawned every frame.
+    Asteroids in the queue still count as being in the game.
+    """
+    def __init__(self, player, per_frame=ASTEROIDS_SPAWN_PER_FRAME, budget_seconds=ASTEROIDS_SPAWN_BUDGET_SECONDS):
+        self.player = player
+        self.per_frame = per_frame
+        self.budget_seconds = budget_seconds
+
+        # Arguments for the asteroids to spawn
+        self.queue = deque()
+
+    @property
+    def pending(self):
+        """
+        Number of asteroids not spawned yet
+        """
+        return len(self.queue)
+
+    def add(self, size, center_x=None, center_y=None, angle=None):
+        """
+        Add an asteroid to the queue
+        """
+        self.queue.append((size, center_x, center_y, angle))
+
+    def add_level(self, level):
+        """
+        Add all the asteroids for a level to the queue
+        """
+        for i in range(asteroids_for_level(level)):
+            self.add(ASTEROIDS_DEFAULT_SIZE)
+
+    def clear(self):
+        """
+        Forget all asteroids not spawned yet
+        """
+        self.queue.clear()
+
+    def update(self, asteroids_list):
+        """
+        Spawn the next asteroids in the queue into asteroids_list.
+        Stops when per_frame asteroids are spawned or the time budget is used.
+        """
+        start = perf_counter()
+        spawned = 0
+
+        while self.queue and spawned < self.per_frame:
+            size, center_x, center_y, angle = self.queue.popleft()
+            # Position is picked now, so the asteroid does not spawn where the player has moved to
+            asteroids_list.append(Asteroid(size, self.player, center_x, center_y, angle))
+            spawned += 1
+
+            # At least one asteroid is spawned every frame, so the queue always gets smaller
+            if perf_counter() - start > self.budget_seconds:
+                break
+
+
 class BonusUFO(arcade.Sprite):
     # when the UFO wraps it says a sound
     try:
@@ -138,8 +627,8 @@ class BonusUFO(arcade.Sprite):
 
     def __init__(self):
         super().__init__(
-            # center_x=SCREEN_WIDTH/2,
-            center_y=SCREEN_HEIGHT / 2,
+            # center_x=WORLD_WIDTH/2,
+            center_y=WORLD_HEIGHT / 2,
             filename="images/ufoGreen.png"
         )
         self.ufo_spawn = 0
@@ -153,19 +642,19 @@ class BonusUFO(arcade.Sprite):
 
         if self.where_to_spawn == 1:
             # Right. When spawning to the left it wraps right.
-            self.center_x = SCREEN_WIDTH + self.width
-            self.center_y = random.randint(0, SCREEN_HEIGHT)
+            self.center_x = WORLD_WIDTH + self.width
+            self.center_y = random.randint(0, WORLD_HEIGHT)
         elif self.where_to_spawn == 2:
             # Left. When spawning to the right it wraps left.
             self.center_x = - 1 * self.width
-            self.center_y = random.randint(0, SCREEN_HEIGHT)
+            self.center_y = random.randint(0, WORLD_HEIGHT)
         elif self.where_to_spawn == 3:
             # Top. When spawning to at the bottom it wraps to the top.
-            self.center_x = random.randint(0, SCREEN_WIDTH)
-            self.center_y = SCREEN_HEIGHT + self.height
+            self.center_x = random.randint(0, WORLD_WIDTH)
+            self.center_y = WORLD_HEIGHT + self.height
         else:
             # Bottom. When spawning to at the top it wraps to the bottom.
-            self.center_x = random.randint(0, SCREEN_WIDTH)
+            self.center_x = random.randint(0, WORLD_WIDTH)
             self.center_y = -1 * self.height
 
         self.change_dir()
@@ -229,20 +718,19 @@ class Player(arcade.Sprite):
 
         self.lives -= 1
 
-        global SOUND_ON
-
-        if SOUND_ON is True:
-            if Player.sound_dies is not None:
-                Player.sound_dies.play()
+        play_sound(Player.sound_dies)
 
         if self.lives < 1:
             return True
         else:
             return False
 
-    def player_thrust(self):
-        self.change_x += PLAYER_THRUST * cos(self.radians + pi / 2)
-        self.change_y += PLAYER_THRUST * sin(self.radians + pi / 2)
+    def player_thrust(self, amount=1.0):
+        """
+        Speed up. amount is from 0 to 1, for sticks pushed part of the way
+        """
+        self.change_x += amount * PLAYER_THRUST * cos(self.radians + pi / 2)
+        self.change_y += amount * PLAYER_THRUST * sin(self.radians + pi / 2)
 
         speed = sqrt(self.change_x ** 2 + self.change_y ** 2)
 
@@ -275,11 +763,6 @@ class PlayerShot(arcade.Sprite):
         """
         Setup new PlayerShot object
         """
-        global SOUND_ON
-        if SOUND_ON is True:
-            if PlayerShot.sound_fire is not None:
-                PlayerShot.sound_fire.play()
-
         # Set the graphics to use for the sprite
         super().__init__("images/Lasers/laserBlue01.png", SPRITE_SCALING)
 
@@ -313,6 +796,9 @@ class StoppableEmitter():
     """
     It is possible to start and stop this emitter
     """
+    # Particles are circles of random sizes. The textures are made once and shared
+    textures = [arcade.make_circle_texture(diameter, arcade.color.CYAN) for diameter in range(7, 31)]
+
     def __init__(self,
             target: arcade.Sprite,
             particle_lifetime: float = 0.5,
@@ -327,6 +813,9 @@ class StoppableEmitter():
         self.emit_interval = emit_interval
         self.particle_count = particle_count
 
+        # Fewer particles when quality is below 1.0
+        self.quality = 1.0
+
         # Emit controller enters endless loop with an interval of 0
         assert self.emit_interval > 0, "Emit interval must be greater than 0"
 
@@ -335,7 +824,7 @@ class StoppableEmitter():
             center_xy=target.position,
             emit_controller = arcade.EmitterIntervalWithCount(self.emit_interval,0),
             particle_factory=lambda emitter: arcade.FadeParticle(
-                filename_or_texture = arcade.make_circle_texture(random.randint(7, 30), arcade.color.CYAN),
+                filename_or_texture = random.choice(StoppableEmitter.textures),
                 change_xy=offset,
                 lifetime=particle_lifetime,
                 start_alpha=start_alpa
@@ -346,7 +835,10 @@ class StoppableEmitter():
         """
         Start emitter
         """
-        self.emitter.rate_factory = arcade.EmitterIntervalWithCount(self.emit_interval, self.particle_count)
+        self.emitter.rate_factory = arcade.EmitterIntervalWithCount(
+            self.emit_interval / self.quality,
+            max(1, round(self.particle_count * self.quality))
+        )
 
     def stop(self):
         """
@@ -360,10 +852,315 @@ class StoppableEmitter():
         self.emitter.update()
 
 
+class QualityGovernor():
+    """
+    Watches how long frames take and lowers the quality of effects when
+    the game runs slow. Quality is raised again when there is time to spare.
+    """
+    def __init__(self,
+            frame_budget: float = QUALITY_FRAME_BUDGET_SECONDS,
+            window_frames: int = QUALITY_WINDOW_FRAMES,
+            lower_at: float = QUALITY_LOWER_AT,
+            raise_at: float = QUALITY_RAISE_AT,
+            step: float = QUALITY_STEP,
+            min_quality: float = QUALITY_MIN):
+
+        self.frame_budget = frame_budget
+        self.lower_at = lower_at
+        self.raise_at = raise_at
+        self.step = step
+        self.min_quality = min_quality
+
+        # 1.0 is full quality
+        self.quality = 1.0
+
+        # Times of the latest frames
+        self.frame_times = deque(maxlen=window_frames)
+
+    def add_frame(self, frame_time):
+        """
+        Add the time a frame took, and change quality if needed.
+        Returns True if quality was changed
+        """
+        self.frame_times.append(frame_time)
+
+        # Wait for a full window of frames before deciding anything
+        if len(self.frame_times) < self.frame_times.maxlen:
+            return False
+
+        average = sum(self.frame_times) / len(self.frame_times)
+
+        if average > self.frame_budget * self.lower_at and self.quality > self.min_quality:
+            self.quality = max(self.min_quality, self.quality - self.step)
+        elif average < self.frame_budget * self.raise_at and self.quality < 1.0:
+            self.quality = min(1.0, self.quality + self.step)
+        else:
+            return False
+
+        # Measure a new window with the new quality
+        self.frame_times.clear()
+        return True
+
+    def particle_count(self, count):
+        return max(1, round(count * self.quality))
+
+    def shake_amplitude(self, amplitude):
+        return amplitude * self.quality
+
+    def sound_voices(self):
+        return max(1, round(SOUND_MAX_VOICES * self.quality))
+
+
+class MemoryTracker():
+    """
+    Samples memory use every interval seconds of play: bytes allocated by Python
+    (with tracemalloc) and the number of objects in each of MEMORY_CATEGORIES.
+    Samples are kept, and written as CSV rows if a path is given.
+    """
+    def __init__(self, interval: float = MEMORY_SAMPLE_SECONDS, path: str = None):
+        self.interval = interval
+        self.path = path
+
+        # Seconds played, and when the next sample is due
+        self.time = 0.0
+        self.next_sample = 0.0
+
+        # Dicts with seconds, traced_kb and a count for each category
+        self.samples = []
+
+        # Only stop tracemalloc in close() if it was started here
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+
+        self.columns = ["seconds", "traced_kb"] + [name for name, object_type in MEMORY_CATEGORIES]
+        if self.path is not None:
+            with open(self.path, "w", newline="") as f:
+                csv.writer(f).writerow(self.columns)
+
+    def update(self, delta_time):
+        """
+        Count delta_time as played, and take a sample if one is due
+        """
+        self.time += delta_time
+        if self.time >= self.next_sample:
+            self.sample()
+            self.next_sample = self.time + self.interval
+
+    def sample(self):
+        sample = {"seconds": round(self.time, 1), "traced_kb": tracemalloc.get_traced_memory()[0] // 1024}
+        sample.update(count_objects())
+        self.samples.append(sample)
+
+        # Written one row at a time, so the samples are kept if the game crashes
+        if self.path is not None:
+            with open(self.path, "a", newline="") as f:
+                csv.writer(f).writerow([sample[name] for name in self.columns])
+
+        return sample
+
+    def growth_per_hour(self, warmup_seconds: float = MEMORY_WARMUP_SECONDS):
+        """
+        Returns how much each category grows per hour: the slope of a straight line
+        fitted to the samples taken after warmup_seconds
+        """
+        samples = [s for s in self.samples if s["seconds"] >= warmup_seconds]
+        if len(samples) < 2:
+            return {}
+
+        hours = [s["seconds"] / 3600 for s in samples]
+        mean_hours = sum(hours) / len(hours)
+        spread = sum((h - mean_hours) ** 2 for h in hours)
+
+        growth = {}
+        for name in self.columns[1:]:
+            values = [s[name] for s in samples]
+            mean_value = sum(values) / len(values)
+            growth[name] = sum((h - mean_hours) * (v - mean_value) for h, v in zip(hours, values)) / spread
+        return growth
+
+    def check(self, max_growth=MEMORY_MAX_GROWTH_PER_HOUR, warmup_seconds: float = MEMORY_WARMUP_SECONDS):
+        """
+        Returns the categories growing faster than max_growth per hour, with their growth
+        """
+        growth = self.growth_per_hour(warmup_seconds)
+        return {name: value for name, value in growth.items() if value > max_growth.get(name, inf)}
+
+    def close(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+
+
+class GameEvents():
+    """
+    Collects events happening in the game and passes them on to
+    the subscribers in batches, once per update
+    """
+    def __init__(self):
+        # Handlers for each type of event
+        self.subscribers = {}
+
+        # Events emitted since last dispatch
+        self.queue = {}
+
+    def subscribe(self, event_type, handler):
+        """
+        Call handler with a list of events every time events of event_type are dispatched
+        """
+        self.subscribers.setdefault(event_type, []).append(handler)
+
+    def emit(self, event_type, **data):
+        """
+        Add an event to the queue. Nothing is called until dispatch()
+        """
+        self.queue.setdefault(event_type, []).append(data)
+
+    def dispatch(self):
+        """
+        Send all queued events to their subscribers
+        """
+        # Swap the queue first, so handlers can emit events for the next dispatch
+        queue, self.queue = self.queue, {}
+
+        for event_type, events in queue.items():
+            for handler in self.subscribers.get(event_type, []):
+                handler(events)
+
+
+class RateLimitedLog():
+    """
+    Writes log messages with key=value fields, at most once per interval for each message.
+    Messages coming too soon are counted, and the count is written with the next one
+    """
+    def __init__(self, log=logger, interval=LOG_INTERVAL_SECONDS):
+        self.log = log
+        self.interval = interval
+
+        # Message -> time it was last written
+        self.last_written = {}
+        # Message -> times it was skipped since then
+        self.skipped = {}
+
+    def write(self, level, message, **fields):
+        # Cheap when the level is turned off, which it is for debug messages by default
+        if not self.log.isEnabledFor(level):
+            return
+
+        now = perf_counter()
+        if now - self.last_written.get(message, -inf) < self.interval:
+            self.skipped[message] = self.skipped.get(message, 0) + 1
+            return
+        self.last_written[message] = now
+
+        skipped = self.skipped.pop(message, 0)
+        if skipped:
+            fields["skipped"] = skipped
+
+        self.log.log(
+            level,
+            "%s %s",
+            message,
+            " ".join("{}={}".format(key, value) for key, value in fields.items()),
+            extra={"fields": fields}
+        )
+
+    def debug(self, message, **fields):
+        self.write(logging.DEBUG, message, **fields)
+
+    def info(self, message, **fields):
+        self.write(logging.INFO, message, **fields)
+
+
+class InputSnapshot(NamedTuple):
+    """
+    What the player wants to do in one update
+    """
+    # From -1 (turn right) to 1 (turn left)
+    rotate: float
+    # From 0 to 1
+    thrust: float
+    # Number of times fire was pressed
+    fire: int
+
+
+class InputBuffer():
+    """
+    Collects keyboard and joystick events between updates. The game reads them
+    once per update with poll(), instead of changing state in the event handlers.
+    Only the latest value of each stick axis is kept, so a stick sending hundreds
+    of events per second costs no more than one event.
+    """
+    def __init__(self, dead_zone: float = INPUT_DEAD_ZONE):
+        self.dead_zone = dead_zone
+
+        # Keys and joystick buttons held down
+        self.keys = set()
+        self.buttons = set()
+
+        # Axis name -> latest value
+        self.axes = {}
+        self.hat = (0, 0)
+
+        # Fire presses since last poll
+        self.fire = 0
+
+    def key_press(self, key):
+        self.keys.add(key)
+        if key == FIRE_KEY:
+            self.fire += 1
+
+    def key_release(self, key):
+        self.keys.discard(key)
+
+    def button_press(self, button):
+        self.buttons.add(button)
+        if button == INPUT_FIRE_BUTTON:
+            self.fire += 1
+
+    def button_release(self, button):
+        self.buttons.discard(button)
+
+    def axis_motion(self, axis, value):
+        self.axes[axis] = value
+
+    def hat_motion(self, hat_x, hat_y):
+        self.hat = (hat_x, hat_y)
+
+    def get_axis(self, axis):
+        """
+        Returns the value of a stick axis from -1 to 1, with the dead zone removed
+        """
+        value = self.axes.get(axis, 0)
+        if abs(value) <= self.dead_zone:
+            return 0.0
+
+        # Scale so values start at 0 just outside the dead zone
+        value = (abs(value) - self.dead_zone) / (1 - self.dead_zone) * (1 if value > 0 else -1)
+        return max(-1.0, min(1.0, value))
+
+    def poll(self):
+        """
+        Returns an InputSnapshot of what the player wants to do now, and forgets the fire presses
+        """
+        rotate = (arcade.key.LEFT in self.keys) - (arcade.key.RIGHT in self.keys) - self.hat[0] - self.get_axis("x")
+
+        # Stick y is -1 when pushed forward
+        thrust = max(
+            float(arcade.key.UP in self.keys or INPUT_THRUST_BUTTON in self.buttons or self.hat[1] > 0),
+            -self.get_axis("y")
+        )
+
+        snapshot = InputSnapshot(max(-1.0, min(1.0, rotate)), thrust, self.fire)
+        self.fire = 0
+        return snapshot
+
+
 class GameView(arcade.View):
     """
     Main application class.
     """
+    # Texture of explosion particles
+    explosion_texture = arcade.make_circle_texture(5, arcade.color.ORANGE)
 
     def on_show_view(self):
 
@@ -373,10 +1170,31 @@ class GameView(arcade.View):
         self.camera_sprites = arcade.Camera(SCREEN_WIDTH, SCREEN_HEIGHT)
         self.camera_GUI = arcade.Camera(SCREEN_WIDTH, SCREEN_HEIGHT)
 
-        # Variable that will hold a list of shots fired by the player
-        self.player_shot_list = None
-        self.asteroids_list = None
-        self.UFO_list = None
+        # Put all textures in the texture atlas now, so all sprite lists use the
+        # same atlas texture and it never has to be rebuilt during the game
+        for texture in get_game_textures():
+            self.window.ctx.default_atlas.add(texture)
+
+        # Player, shots and UFOs are drawn with one draw call. They are also in their own lists for the game logic
+        self.ships_list = arcade.SpriteList()
+
+        # Draw calls in the last frame
+        self.draw_calls = 0
+
+        # Sprite lists are made once and reused on every reset
+        self.player_shot_list = arcade.SpriteList()
+
+        # Room for the biggest level and the asteroids split off it, so the lists do not have to grow
+        self.asteroids_list = SpriteChunks(capacity=ASTEROIDS_CAPACITY)
+
+        # Asteroid chunks close to the screen. Only these are updated
+        self.awake_asteroids_lists = []
+
+        self.UFO_list = arcade.SpriteList()
+
+        # Emitter list
+        self.emitter_list = []
+
         self.is_paused = False
         self.paused_time_left = inf
         self.level = 1
@@ -386,37 +1204,53 @@ class GameView(arcade.View):
         self.shots_hit = 0
         self.shots_accuracy = 0
 
+        # Lowers the quality of effects if the game runs slow
+        self.quality_governor = QualityGovernor()
+
+        # Things happening in the game are sent to the subscribers once per update
+        self.events = GameEvents()
+        self.events.subscribe(EVENT_SHOT_FIRED, self.on_shots_fired)
+        self.events.subscribe(EVENT_SHOT_EXPIRED, self.on_shots_missed)
+        self.events.subscribe(EVENT_ASTEROID_SPLIT, self.on_asteroids_hit)
+        self.events.subscribe(EVENT_UFO_KILLED, self.on_ufos_hit)
+        self.events.subscribe(EVENT_PLAYER_DIED, self.on_player_died)
+        self.events.subscribe(EVENT_LEVEL_CLEARED, self.on_level_cleared)
+
         # Set up the player info
         self.player_sprite = None
 
         self.player_sprite = Player()
+        self.ships_list.append(self.player_sprite)
 
         # Define player_rocket_emitter
         self.player_rocket_emitter = StoppableEmitter(self.player_sprite)
 
-        self.mute_icon = arcade.Sprite(
-            filename="images/Icons/audioOff.png",
-            center_y=SCREEN_HEIGHT-SCREEN_HEIGHT/10,
-            center_x=SCREEN_WIDTH-SCREEN_WIDTH/15
-        )
+        # Asteroids are spawned from here, a few every frame
+        self.asteroid_spawner = AsteroidSpawner(self.player_sprite)
+
+        self.mute_texture = arcade.load_texture("images/Icons/audioOff.png")
+        self.unmute_texture = arcade.load_texture("images/Icons/audioOn.png")
 
-        self.unmute_icon = arcade.Sprite(
-            filename="images/Icons/audioOn.png",
+        # One icon which changes texture when muting and unmuting
+        self.sound_icon = arcade.Sprite(
+            texture=self.unmute_texture,
             center_y=SCREEN_HEIGHT-SCREEN_HEIGHT/10,
             center_x=SCREEN_WIDTH-SCREEN_WIDTH/15
         )
+        self.icons_list = arcade.SpriteList()
+        self.icons_list.append(self.sound_icon)
 
-        # Track the current state of what key is pressed
-        self.left_pressed = False
-        self.right_pressed = False
-        self.up_pressed = False
-        self.down_pressed = False
+        # Keyboard and joystick events, read once per update
+        self.input = InputBuffer()
+
+        # Joysticks send many events, so they are logged at most once a second
+        self.input_log = RateLimitedLog()
 
         # Get list of joysticks
         joysticks = arcade.get_joysticks()
 
         if joysticks:
-            print("Found {} joystick(s)".format(len(joysticks)))
+            logger.info("joysticks found count=%d", len(joysticks))
 
             # Use 1st joystick found
             self.joystick = joysticks[0]
@@ -431,7 +1265,7 @@ class GameView(arcade.View):
             self.joystick.on_joyhat_motion = self.on_joyhat_motion
 
         else:
-            print("No joysticks found")
+            logger.info("joysticks found count=0")
             self.joystick = None
 
             # self.joystick.
@@ -442,28 +1276,22 @@ class GameView(arcade.View):
     def reset(self):
         """ Set up the game and initialize the variables. """
 
-        # Sprite lists
-        self.player_shot_list = arcade.SpriteList()
+        # Empty the sprite lists, but keep them so their buffers are reused
+        empty_sprite_list(self.player_shot_list)
+        self.asteroids_list.empty()
+        empty_sprite_list(self.UFO_list)
 
-        # Asteroid list
-        self.asteroids_list = arcade.SpriteList()
-
-        for i in range(ASTEROIDS_PER_LEVEL):
-            self.asteroids_list.append(Asteroid(ASTEROIDS_DEFAULT_SIZE, self.player_sprite))
+        # Asteroids for this level will appear over the next frames
+        self.asteroid_spawner.clear()
+        self.asteroid_spawner.add_level(self.level)
 
         # Time between asteroid spawn
         self.asteroids_timer_seconds = ASTEROIDS_TIMER_SECONDS
 
-        # UFO list
-        self.UFO_list = arcade.SpriteList()
         self.UFO_spawn_timer = 0
 
-        # Emitter list
-        self.emitter_list = []
-        
-        # Player rocket emitter
-        self.player_rocket_emitter = StoppableEmitter(self.player_sprite)
-        # self.emitter_list.append(self.player_rocket_emitter.emitter)
+        # Remove explosions
+        self.emitter_list.clear()
 
         # Reset player position
         self.player_sprite.center_x = PLAYER_START_X
@@ -502,34 +1330,37 @@ class GameView(arcade.View):
         # This command has to happen before we start drawing
         arcade.start_render()
 
-        # Draw the player shot
-        self.player_shot_list.draw()
+        # Count draw calls made in this frame
+        draw_calls = 0
 
         # Draw emitters
         for e in self.emitter_list:
             e.draw()
+            draw_calls += 1
 
         # Draw player rocket
         self.player_rocket_emitter.emitter.draw()
+        draw_calls += 1
 
-        # Draw the player sprite
-        self.player_sprite.draw()
-
-        # Draw the asteriod(s)
-        self.asteroids_list.draw()
+        # Draw the asteriod(s) on the screen
+        for asteroids in self.get_asteroids_lists():
+            asteroids.draw()
+            draw_calls += 1
 
-        # Draw UFO
-        self.UFO_list.draw()
+        # Draw the player, player shots and UFOs
+        self.ships_list.draw()
+        draw_calls += 1
 
         # Use the camera
         self.camera_GUI.use()
 
         # Draw mute icon
         if SOUND_ON is False:
-            self.mute_icon.draw()
+            self.sound_icon.texture = self.mute_texture
         else:
-            self.unmute_icon.draw()
-
+            self.sound_icon.texture = self.unmute_texture
+        self.icons_list.draw()
+        draw_calls += 1
 
         # Draw players score on screen
         arcade.draw_text(
@@ -567,7 +1398,205 @@ class GameView(arcade.View):
             font_name = FONT_NAME
         )
 
+        # Score, lives, level and accuracy
+        draw_calls += 4
+
+        if SHOW_DRAW_CALLS:
+            # Shows the count from the last frame, as this text is a draw call too
+            arcade.draw_text(
+                "DRAW CALLS: {}".format(self.draw_calls),  # text to show
+                5,  # X position
+                SCREEN_HEIGHT - 140,  # Y position
+                arcade.color.WHITE,  # color of text
+                font_name = FONT_NAME
+            )
+            draw_calls += 1
+
+        self.draw_calls = draw_calls
+
+    def update_accuracy(self, shots_fired, shots_hit):
+        """
+        Add shots to the statistics and calculate the new accuracy
+        """
+        self.shots_fired += shots_fired
+        self.shots_hit += shots_hit
+        if self.shots_fired > 0:
+            self.shots_accuracy = self.shots_hit / self.shots_fired
+
+    def on_shots_fired(self, events):
+        for e in events:
+            play_sound(PlayerShot.sound_fire)
+
+    def on_shots_missed(self, events):
+        self.update_accuracy(len(events), 0)
+
+    def on_asteroids_hit(self, events):
+        self.update_accuracy(len(events), len(events))
+
+        for e in events:
+            # Big asteroids gives less points. Points are given for both halves of the split
+            self.player_sprite.score += 2 * (ASTEROIDS_MAX_POINTS // e["size"])
+
+            # Asteroids explosion
+            self.emitter_list.append(self.get_explosion(e["center_x"], e["center_y"]))
+
+    def on_ufos_hit(self, events):
+        self.update_accuracy(len(events), len(events))
+
+        for e in events:
+            self.player_sprite.score += e["value"]
+
+    def on_player_died(self, events):
+        for e in events:
+            self.emitter_list.append(self.get_explosion(e["center_x"], e["center_y"]))
+        self.shake_cam(self.quality_governor.shake_amplitude(SHAKE_AMPLITUDE))
+
+    def on_level_cleared(self, events):
+        self.level += len(events)
+        self.reset()
+
+    def get_asteroids_lists(self, margin=0):
+        """
+        Returns the asteroid chunks on the screen, or up to margin outside of it
+        """
+        left, bottom = self.camera_sprites.goal_position
+        return self.asteroids_list.get_lists(
+            left - margin,
+            bottom - margin,
+            left + SCREEN_WIDTH + margin,
+            bottom + SCREEN_HEIGHT + margin
+        )
+
+    def get_asteroids_hit(self, sprite):
+        """
+        Returns the awake asteroids colliding with sprite
+        """
+        asteroids_hit = []
+        for asteroids in self.awake_asteroids_lists:
+            asteroids_hit.extend(sprite.collides_with_list(asteroids))
+        return asteroids_hit
+
+    def follow_player(self):
+        """
+        Move the camera so the player is in the middle, without showing anything outside of the world
+        """
+        left = min(max(self.player_sprite.center_x - SCREEN_WIDTH / 2, 0), WORLD_WIDTH - SCREEN_WIDTH)
+        bottom = min(max(self.player_sprite.center_y - SCREEN_HEIGHT / 2, 0), WORLD_HEIGHT - SCREEN_HEIGHT)
+        self.camera_sprites.move_to(Vec2(left, bottom))
+
+    def save_state(self):
+        """
+        Returns the state of the game packed into bytes
+        """
+        pending = list(self.asteroid_spawner.queue)
+
+        values = array("d")
+        values.extend(pack_sprites([self], SNAPSHOT_GAME_FIELDS))
+        values.extend(pack_sprites([self.player_sprite], SNAPSHOT_PLAYER_FIELDS))
+        values.extend(pack_sprites(self.asteroids_list, SNAPSHOT_ASTEROID_FIELDS))
+        values.extend(pack_sprites(self.UFO_list, SNAPSHOT_UFO_FIELDS))
+        values.extend(pack_sprites(self.player_shot_list, SNAPSHOT_SHOT_FIELDS))
+        values.extend([nan if v is None else v for spawn in pending for v in spawn])
+
+        # Save states are little-endian on every machine, like the header
+        if sys.byteorder == "big":
+            values.byteswap()
+
+        header = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC,
+            SNAPSHOT_VERSION,
+            len(self.asteroids_list),
+            len(self.UFO_list),
+            len(self.player_shot_list),
+            len(pending)
+        )
+
+        return header + values.tobytes()
+
+    def restore_state(self, data):
+        """
+        Set the game to a state made by save_state(). data can be bytes or
+        any other buffer, like an mmap of a saved file, as it is read without copying.
+        Raises ValueError if data is not a whole save state, and leaves the game unchanged.
+        """
+        data = memoryview(data).cast("B")
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("Save state is too short")
+
+        magic, version, asteroid_count, ufo_count, shot_count, pending_count = SNAPSHOT_HEADER.unpack_from(data)
+
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("Not a save state of version {}".format(SNAPSHOT_VERSION))
+
+        # A cut off or corrupt save state would restore only some of the sprites
+        value_count = (
+            len(SNAPSHOT_GAME_FIELDS)
+            + len(SNAPSHOT_PLAYER_FIELDS)
+            + asteroid_count * len(SNAPSHOT_ASTEROID_FIELDS)
+            + ufo_count * len(SNAPSHOT_UFO_FIELDS)
+            + shot_count * len(SNAPSHOT_SHOT_FIELDS)
+            + pending_count * SNAPSHOT_SPAWN_FIELDS
+        )
+        if len(data) != SNAPSHOT_HEADER.size + value_count * 8:
+            raise ValueError("Save state has {} bytes, expected {}".format(
+                len(data), SNAPSHOT_HEADER.size + value_count * 8
+            ))
+
+        if sys.byteorder == "little":
+            values = data[SNAPSHOT_HEADER.size:].cast("d")
+        else:
+            values = array("d")
+            values.frombytes(data[SNAPSHOT_HEADER.size:])
+            values.byteswap()
+
+        offset = unpack_sprites([self], values, 0, SNAPSHOT_GAME_FIELDS)
+        offset = unpack_sprites([self.player_sprite], values, offset, SNAPSHOT_PLAYER_FIELDS)
+
+        # Sprites are changed where they are, and only made or removed if the counts differ
+        asteroids, new_asteroids = reuse_sprites(
+            self.asteroids_list, asteroid_count, lambda: Asteroid(ASTEROIDS_DEFAULT_SIZE, self.player_sprite)
+        )
+        offset = unpack_sprites(asteroids, values, offset, SNAPSHOT_ASTEROID_FIELDS)
+        for a in asteroids:
+            # Changing the scale is slow, as it changes the hit box
+            scale = SPRITE_SCALING * ASTEROIDS_SCALE * a.size
+            if a.scale != scale:
+                a.scale = scale
+        for a in new_asteroids:
+            self.asteroids_list.append(a)
+        # Asteroids which were moved to another chunk
+        self.asteroids_list.move_sprites(self.asteroids_list.chunks.values())
+
+        ufos, new_ufos = reuse_sprites(self.UFO_list, ufo_count, BonusUFO)
+        offset = unpack_sprites(ufos, values, offset, SNAPSHOT_UFO_FIELDS)
+        for u in new_ufos:
+            self.UFO_list.append(u)
+            self.ships_list.append(u)
+
+        shots, new_shots = reuse_sprites(self.player_shot_list, shot_count, lambda: PlayerShot(self.player_sprite))
+        offset = unpack_sprites(shots, values, offset, SNAPSHOT_SHOT_FIELDS)
+        for s in new_shots:
+            self.player_shot_list.append(s)
+            self.ships_list.append(s)
+
+        self.asteroid_spawner.clear()
+        for i in range(pending_count):
+            size, center_x, center_y, angle = values[offset:offset + SNAPSHOT_SPAWN_FIELDS]
+            self.asteroid_spawner.add(
+                int(size),
+                None if isnan(center_x) else center_x,
+                None if isnan(center_y) else center_y,
+                None if isnan(angle) else angle
+            )
+            offset += SNAPSHOT_SPAWN_FIELDS
+
+        # Explosions are not saved
+        self.emitter_list.clear()
+
     def game_over(self):
+        # Score and accuracy must include everything that happened this update
+        self.events.dispatch()
+
         #menu_view = GameOverView(self.player_sprite.score)
         menu_view = GameOverView()
         menu_view.setup_scores("MyUser", self.player_sprite.score + round(self.player_sprite.score * self.shots_accuracy))
@@ -575,7 +1604,7 @@ class GameView(arcade.View):
 
     def screen_wrap(self, list_to_wrap):
         """
-        Object wraps around screen.
+        Object wraps around the world.
         returns True if something wraps else False
         """
         some_thing_wrapped = False
@@ -583,16 +1612,16 @@ class GameView(arcade.View):
         for p in list_to_wrap:
             # wrap on x axis
             if p.right < 0:
-                p.left = SCREEN_WIDTH
+                p.left = WORLD_WIDTH
                 some_thing_wrapped = True
-            elif p.left > SCREEN_WIDTH:
+            elif p.left > WORLD_WIDTH:
                 p.right = 0
                 some_thing_wrapped = True
             # wrap on y axis
             if p.top < 0:
-                p.bottom = SCREEN_HEIGHT
+                p.bottom = WORLD_HEIGHT
                 some_thing_wrapped = True
-            elif p.bottom > SCREEN_HEIGHT:
+            elif p.bottom > WORLD_HEIGHT:
                 p.top = 0
                 some_thing_wrapped = True
 
@@ -602,8 +1631,8 @@ class GameView(arcade.View):
 
         new_emitter = arcade.make_burst_emitter(
             center_xy=[pos_x, pos_y],
-            filenames_and_textures = [arcade.make_circle_texture(5, arcade.color.ORANGE)],
-            particle_count=10,
+            filenames_and_textures = [GameView.explosion_texture],
+            particle_count=self.quality_governor.particle_count(10),
             particle_speed=10,
             particle_lifetime_min=2,
             particle_lifetime_max=5)
@@ -615,12 +1644,28 @@ class GameView(arcade.View):
         """
         Movement and game logic
         """
+        global sound_voices_left
+
+        # Effects get simpler if frames take too long. The game logic below is never changed
+        self.quality_governor.add_frame(delta_time)
+        self.player_rocket_emitter.quality = self.quality_governor.quality
+        sound_voices_left = self.quality_governor.sound_voices()
 
         # Emitters can not be paused
         for e in self.emitter_list:
             e.update()
         self.player_rocket_emitter.update()
 
+        # Explosions are removed when all their particles are gone. Each has its own SpriteList
+        self.emitter_list = [e for e in self.emitter_list if not e.can_reap()]
+
+        # Everything the player did since the last update
+        player_input = self.input.poll()
+
+        # Shots can be fired while paused, like before input was buffered
+        for i in range(player_input.fire):
+            self.fire_shot()
+
         if self.is_paused:
             # Decrease time until pause ends
             self.paused_time_left -= delta_time
@@ -633,16 +1678,19 @@ class GameView(arcade.View):
                     self.game_over()
                 self.reset()
 
+            # Shots fired while paused must be heard now, not when the pause ends
+            self.events.dispatch()
+
             # Skip on_update when game is paused
             return
 
+        # Asteroids far away from the screen sleep until the player gets close
+        self.awake_asteroids_lists = self.get_asteroids_lists(CHUNK_WAKE_DISTANCE)
+
         # Do player_shot and UFO collide?
         for s in self.player_shot_list:
             for u in s.collides_with_list(self.UFO_list):
-                self.shots_fired += 1
-                self.shots_hit += 1
-                self.shots_accuracy = self.shots_hit / self.shots_fired
-                self.player_sprite.score += u.value
+                self.events.emit(EVENT_UFO_KILLED, value=u.value)
                 s.kill()
                 u.kill()
 
@@ -650,8 +1698,11 @@ class GameView(arcade.View):
         for u in self.player_sprite.collides_with_list(self.UFO_list):
             u.kill()
             self.player_sprite.dies()
-            self.emitter_list.append(self.get_explosion(self.player_sprite.center_x, self.player_sprite.center_y))
-            self.shake_cam(SHAKE_AMPLITUDE)
+            self.events.emit(
+                EVENT_PLAYER_DIED,
+                center_x=self.player_sprite.center_x,
+                center_y=self.player_sprite.center_y
+            )
             self.is_paused = True
             self.paused_time_left = GAME_PAUSE_LENGTH_SECONDS
 
@@ -660,34 +1711,29 @@ class GameView(arcade.View):
 
         # Asteroid hit by player_shot
         for s in self.player_shot_list:
-            for a in s.collides_with_list(self.asteroids_list):
-                self.shots_fired += 1
-                self.shots_hit += 1
-                self.shots_accuracy = self.shots_hit / self.shots_fired
-                
-                # Asteroids explosion
-                self.emitter_list.append(self.get_explosion(a.center_x, a.center_y))
-                
+            for a in self.get_asteroids_hit(s):
+                self.events.emit(EVENT_ASTEROID_SPLIT, size=a.size, center_x=a.center_x, center_y=a.center_y)
+
                 # split off two asteroids going left or right
                 for direction in [-1, 1]:
                     # only split if size is bigger than one
                     if a.size > 1:
                         # + 90 to s.angle because the angle is changed to match the graphic
                         new_angle = (s.angle + 90) + (direction * random.randint(0, ASTEROIDS_MAX_SPLIT_ANGLE))
-                        self.asteroids_list.append(
-                            Asteroid(a.size-1, self.player_sprite, a.center_x, a.center_y, new_angle)
-                        )
-                        # Big asteroids gives less points
-                    self.player_sprite.score += ASTEROIDS_MAX_POINTS//a.size
+                        # Spawned later in this update, or in the next ones if there are many
+                        self.asteroid_spawner.add(a.size-1, a.center_x, a.center_y, new_angle)
                 s.kill()
                 a.kill()
 
         # Kill asteroids who collide with player and make player loose a life
-        for a in self.player_sprite.collides_with_list(self.asteroids_list):
+        for a in self.get_asteroids_hit(self.player_sprite):
             a.kill()
             self.player_sprite.dies()
-            self.emitter_list.append(self.get_explosion(self.player_sprite.center_x, self.player_sprite.center_y))
-            self.shake_cam(SHAKE_AMPLITUDE)
+            self.events.emit(
+                EVENT_PLAYER_DIED,
+                center_x=self.player_sprite.center_x,
+                center_y=self.player_sprite.center_y
+            )
             self.is_paused = True
             self.paused_time_left = GAME_PAUSE_LENGTH_SECONDS
 
@@ -697,16 +1743,15 @@ class GameView(arcade.View):
 
         if self.UFO_spawn_timer <= 0:
             self.UFO_spawn_timer = random.randint(UFO_CHANGE_DIR_TIME_MIN, UFO_SPAWN_TIME_MAX)
-            self.UFO_list.append(BonusUFO())
+            new_ufo = BonusUFO()
+            self.UFO_list.append(new_ufo)
+            self.ships_list.append(new_ufo)
 
-        # Move player with keyboard
-        if self.left_pressed and not self.right_pressed:
-            self.player_sprite.angle += PLAYER_ROTATE_SPEED
-        elif self.right_pressed and not self.left_pressed:
-            self.player_sprite.angle -= PLAYER_ROTATE_SPEED
+        # Move player with keyboard or joystick
+        self.player_sprite.angle += player_input.rotate * PLAYER_ROTATE_SPEED
 
-        if self.up_pressed:
-            self.player_sprite.player_thrust()
+        if player_input.thrust > 0:
+            self.player_sprite.player_thrust(player_input.thrust)
             self.player_rocket_emitter.start()
 
         # Update player sprite
@@ -718,8 +1763,7 @@ class GameView(arcade.View):
         for s in self.player_shot_list:
             # Removes/kills player shot if it moves longer than the range
             if s.distance_traveled > PLAYER_SHOT_RANGE:
-                self.shots_fired += 1
-                self.shots_accuracy = self.shots_hit / self.shots_fired
+                self.events.emit(EVENT_SHOT_EXPIRED)
                 s.kill()
 
         # Time between asteroid spawn count down
@@ -727,58 +1771,62 @@ class GameView(arcade.View):
 
         # Make new asteroid if the right amount of time has passed
         if self.asteroids_timer_seconds <= 0:
-            self.asteroids_list.append(Asteroid(ASTEROIDS_DEFAULT_SIZE, self.player_sprite))
+            self.asteroid_spawner.add(ASTEROIDS_DEFAULT_SIZE)
             self.asteroids_timer_seconds = ASTEROIDS_TIMER_SECONDS
 
+        # Spawn some of the asteroids waiting in the queue
+        self.asteroid_spawner.update(self.asteroids_list)
+
         # Update the asteroids
-        self.asteroids_list.on_update(delta_time)
+        for asteroids in self.awake_asteroids_lists:
+            asteroids.on_update(delta_time)
 
         # Update the UFOs
         self.UFO_list.on_update(delta_time)
 
         # Asteroids wraps
-        self.screen_wrap(self.asteroids_list)
+        for asteroids in self.awake_asteroids_lists:
+            self.screen_wrap(asteroids)
+
+        # Asteroids who moved to another chunk
+        self.asteroids_list.move_sprites(self.awake_asteroids_lists)
 
         # Player wraps
         self.screen_wrap([self.player_sprite])
 
+        # Camera follows the player
+        self.follow_player()
+
         # Shot wraps
         self.screen_wrap(self.player_shot_list)
 
         # UFO wraps
         a_ufo_wrapped = self.screen_wrap(self.UFO_list)
-        if a_ufo_wrapped == True and SOUND_ON:
-            BonusUFO.sound_wraps.play()
+        if a_ufo_wrapped:
+            play_sound(BonusUFO.sound_wraps)
+
+        # Level is cleared when all asteroids are shot, including those waiting to spawn
+        if len(self.asteroids_list) + self.asteroid_spawner.pending == 0:
+            self.events.emit(EVENT_LEVEL_CLEARED, level=self.level)
 
-        if SOUND_ON is True:
-            if a_ufo_wrapped and BonusUFO.sound_wraps is not None:
-                BonusUFO.sound_wraps.play()
+        # Let subscribers handle everything that happened in this update
+        self.events.dispatch()
+
+    def fire_shot(self):
+        new_shot = PlayerShot(
+            self.player_sprite
+        )
 
-        if len(self.asteroids_list) == 0:
-            self.reset()
-            self.level += 1
+        self.player_shot_list.append(new_shot)
+        self.ships_list.append(new_shot)
+        self.events.emit(EVENT_SHOT_FIRED)
 
     def on_key_press(self, key, modifiers):
         """
         Called whenever a key is pressed.
         """
-
-        # Track state of arrow keys
-        if key == arcade.key.UP:
-            self.up_pressed = True
-        elif key == arcade.key.DOWN:
-            self.down_pressed = True
-        elif key == arcade.key.LEFT:
-            self.left_pressed = True
-        elif key == arcade.key.RIGHT:
-            self.right_pressed = True
-
-        if key == FIRE_KEY:
-            new_shot = PlayerShot(
-                self.player_sprite
-            )
-
-            self.player_shot_list.append(new_shot)
+        # Arrow keys and fire are handled in the next update
+        self.input.key_press(key)
 
         global SOUND_ON
         if key == MUTE_KEY:
@@ -788,45 +1836,24 @@ class GameView(arcade.View):
         """
         Called whenever a key is released.
         """
-
-        if key == arcade.key.UP:
-            self.up_pressed = False
-        elif key == arcade.key.DOWN:
-            self.down_pressed = False
-        elif key == arcade.key.LEFT:
-            self.left_pressed = False
-        elif key == arcade.key.RIGHT:
-            self.right_pressed = False
+        self.input.key_release(key)
 
     def on_joybutton_press(self, joystick, button_no):
-        print("Button pressed:", button_no)
-
-        if button_no == 0:
-            self.up_pressed = True
-
-        # Press the fire key
-        if button_no == 1:
-            self.on_key_press(FIRE_KEY, [])
+        self.input_log.debug("joystick button pressed", button=button_no)
+        self.input.button_press(button_no)
 
     def on_joybutton_release(self, joystick, button_no):
-        print("Button released:", button_no)
-        self.up_pressed = False
-
+        self.input_log.debug("joystick button released", button=button_no)
+        self.input.button_release(button_no)
 
     def on_joyaxis_motion(self, joystick, axis, value):
-        print("Joystick axis {}, value {}".format(axis, value))
-        
-        if axis == "x":
-            if value == -1:
-                self.left_pressed = True
-            elif value == 1:
-                self.right_pressed = True
-            else:
-                self.right_pressed = False
-                self.left_pressed = False
+        self.input_log.debug("joystick axis moved", axis=axis, value=round(value, 2))
+        self.input.axis_motion(axis, value)
 
     def on_joyhat_motion(self, joystick, hat_x, hat_y):
-        print("Joystick hat ({}, {})".format(hat_x, hat_y))
+        self.input_log.debug("joystick hat moved", x=hat_x, y=hat_y)
+        self.input.hat_motion(hat_x, hat_y)
+
 
 class MenuView(arcade.View):
 
@@ -864,7 +1891,7 @@ class GameOverView(arcade.View):
             # Negating score when sorting so the largest score comes first
             self.highscores.sort(key=lambda highscores: -1 * highscores['score'])
             with open("highscores.yml", "w") as f:
-                yaml.dump(self.highscores, f)
+                yaml.dump(self.highscores[:HIGHSCORES_KEEP], f)
         except FileNotFoundError:
             # Hardcoded highscores that will be fetched from a file in the future
             # If file dosen't exist it creates a new one
@@ -938,9 +1965,16 @@ def main():
     """
     Main method
     """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
 
     window = arcade.Window(SCREEN_WIDTH, SCREEN_HEIGHT,
                            "☆〉Asteroids")
+
+    # Samples are taken in every view, also in menus
+    if MEMORY_TRACKING:
+        memory_tracker = MemoryTracker(path=MEMORY_LOG_FILE)
+        arcade.schedule(memory_tracker.update, MEMORY_SAMPLE_SECONDS)
+
     menu_view = MenuView()
     window.show_view(menu_view)
     arcade.run()